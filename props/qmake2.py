@@ -3,14 +3,35 @@
 
 import subprocess
 import re
+import sre_parse
 import os
+import ntpath
 import sys
 import codecs
-import string
 import uuid
 import signal
 import tempfile
 import shutil
+import multiprocessing
+import multiprocessing.pool
+import threading
+import traceback
+import hashlib
+import time
+import collections
+import filecmp
+import itertools
+import json
+import gzip
+import Queue
+import timeit
+import heapq
+import ast
+import glob
+import fnmatch
+import xml.parsers.expat
+import xml.sax.saxutils
+import xml.etree.cElementTree
 
 end_project = '</Project>'
 
@@ -21,6 +42,7 @@ class GlobalInfo:
     path = ""
     path_re = ""
     temp_mkspec = ""
+    keep_mkspec = False
     platformToolset = ""
     MSC_VER = 0
     MSC_FULL_VER = 0
@@ -44,43 +66,511 @@ class GlobalInfo:
 
 globalInfo = GlobalInfo()
 
+class Options:
+    jobs = multiprocessing.cpu_count()
+    cache = True
+    cache_dir = os.environ.get('QMAKE2_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.qmake2', 'cure')
+    cache_size = 256 << 20
+    stream = False
+    # '-' prints a table to stderr at exit, anything else is the path of a JSON/Chrome trace file; QMAKE2_PROFILE=1 asks for the table
+    profile = '-' if os.environ.get('QMAKE2_PROFILE', '').lower() in ('1', 'true', 'yes') else None
+    sln_reduce_deps = False
+    env_cache = True
+    env_cache_dir = os.environ.get('QMAKE2_ENV_DIR') or os.path.join(os.path.expanduser('~'), '.qmake2', 'env')
+    # cached mkspecs no run has used for this many days are removed
+    env_cache_days = 30
+    batch = None
+    batch_jobs = multiprocessing.cpu_count()
+    # how .vcxproj files are cured: 'lines' runs every rule over every line, 'xml' over the parsed elements
+    engine = 'lines'
+    watch = False
+    watch_interval = 0.5
+    # rerun qmake only for the projects whose inputs changed since the manifest of the last run
+    incremental = False
+    # with --incremental, ignore the manifest of the last run and regenerate the whole tree
+    full = False
+    moc_index = True
+    # also drop include and library directories which don't exist when the project is cured
+    drop_missing_dirs = False
+    # share of a project's sources which must include a header before it is precompiled, 0 leaves projects without a pch alone
+    auto_pch = 0
+    auto_pch_min_sources = 8
+    # path of a .gz or .zst file getting a copy of qmake's debug output
+    qmake_log = None
+    # number of unity bundles the ClCompile sources of each project are grouped into, 0 leaves them alone
+    unity = 0
+    # write the Qt and toolset blocks every project shares into sheets beside the solution, which the projects import
+    shared_props = False
+    # directories the shared sheets are written into, the solution directory of every tree
+    shared_roots = ()
+
+options = Options()
+
+def _choice(name, choices):
+    def convert(value):
+        if value not in choices:
+            raise Exception('--%s must be one of: %s' % (name, ', '.join(choices)))
+        return value
+
+    return convert
+
+_arg_options = {
+    'jobs': ('jobs', lambda value: max(1, int(value))),
+    'no-cache': ('cache', False),
+    'cache-dir': ('cache_dir', os.path.abspath),
+    'cache-size': ('cache_size', lambda value: int(value) << 20),
+    'stream': ('stream', True),
+    'profile': ('profile', os.path.abspath, '-'),
+    'sln-reduce-deps': ('sln_reduce_deps', True),
+    'no-env-cache': ('env_cache', False),
+    'env-cache-dir': ('env_cache_dir', os.path.abspath),
+    'env-cache-days': ('env_cache_days', lambda value: max(0.0, float(value))),
+    'batch': ('batch', os.path.abspath),
+    'batch-jobs': ('batch_jobs', lambda value: max(1, int(value))),
+    'engine': ('engine', _choice('engine', ('lines', 'xml'))),
+    'watch': ('watch', True),
+    'watch-interval': ('watch_interval', float),
+    'incremental': ('incremental', True),
+    'full': ('full', True),
+    'no-moc-index': ('moc_index', False),
+    'unity': ('unity', lambda value: max(0, int(value)), multiprocessing.cpu_count()),
+    'drop-missing-dirs': ('drop_missing_dirs', True),
+    'auto-pch': ('auto_pch', lambda value: min(1.0, max(0.0, float(value))), 0.5),
+    'auto-pch-min-sources': ('auto_pch_min_sources', lambda value: max(1, int(value))),
+    'qmake-log': ('qmake_log', os.path.abspath),
+    'shared-props': ('shared_props', True),
+}
+
+# options which change what a doctor produces, and so belong in the cure cache key
+_cure_options = ('sln_reduce_deps', 'unity', 'drop_missing_dirs', 'auto_pch', 'auto_pch_min_sources', 'shared_props')
+# options which change what a run writes, and so belong in the manifest of --incremental
+_output_options = _cure_options + ('engine', 'stream', 'moc_index')
+
+_clock = timeit.default_timer
+
+class _Profile:
+    """handler, file and stage timings collected when profiling is enabled"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.files = []
+        self.events = []
+        self.lock = threading.Lock()
+
+    def handler_stats(self, name):
+        return self.handlers.setdefault(name, [0, 0, 0, 0.0])
+
+    def span(self, name, start, end, **args):
+        self.events.append({'name': name, 'cat': 'qmake2', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                            'ts': int(start * 1e6), 'dur': int((end - start) * 1e6), 'args': args})
+
+    def take(self):
+        data = (self.handlers, self.files, self.events)
+        self.__init__()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            self._merge(data)
+
+    def _merge(self, data):
+        handlers, files, events = data
+        for name, stats in handlers.iteritems():
+            self.handler_stats(name)[:] = map(sum, zip(self.handler_stats(name), stats))
+        self.files += files
+        self.events += events
+
+    def _handler_summary(self):
+        return dict((name, {'calls': calls, 'hits': hits, 'skipped': skipped, 'seconds': seconds})
+                    for name, (calls, hits, skipped, seconds) in self.handlers.iteritems())
+
+    def report(self, target):
+        if target != '-':
+            with open(target, 'w') as f:
+                json.dump({'traceEvents': self.events, 'handlers': self._handler_summary(), 'files': self.files}, f, indent=1, sort_keys=True)
+            print 'Profile written to %s' % target
+            return
+
+        print >> sys.stderr, '%-64s %9s %9s %9s %10s' % ('handler', 'calls', 'hits', 'skipped', 'seconds')
+        for name, (calls, hits, skipped, seconds) in sorted(self.handlers.iteritems(), key=lambda x: -x[1][3]):
+            print >> sys.stderr, '%-64s %9d %9d %9d %10.4f' % (name[:64], calls, hits, skipped, seconds)
+
+        stages = {}
+        for event in self.events:
+            stages[event['name']] = stages.get(event['name'], 0) + event['dur'] / 1e6
+        print >> sys.stderr
+        print >> sys.stderr, '%-64s %10s' % ('stage', 'seconds')
+        for name, seconds in sorted(stages.iteritems(), key=lambda x: -x[1]):
+            print >> sys.stderr, '%-64s %10.4f' % (name, seconds)
+
+        print >> sys.stderr
+        print >> sys.stderr, '%-64s %10s %10s %10s %10s' % ('slowest files', 'load', 'cure', 'save', 'encoding')
+        for record in sorted(self.files, key=lambda r: -sum(r.get(k, 0) for k in ('load', 'cure', 'save')))[:10]:
+            print >> sys.stderr, '%-64s %10.4f %10.4f %10.4f %10s' % (record['path'][-64:], record.get('load', 0), record.get('cure', 0), record.get('save', 0), record.get('encoding') or '-')
+
+        encodings = collections.Counter(record.get('encoding') for record in self.files if record.get('encoding'))
+        if encodings:
+            print >> sys.stderr
+            print >> sys.stderr, 'encodings: ' + ', '.join('%s %d' % item for item in sorted(encodings.iteritems()))
+
+_profiler = _Profile()
+
+class _FileTimer:
+    def __init__(self, path, doctor):
+        self.record = {'path': path, 'doctor': doctor.__name__}
+        self.last = time.time()
+
+    def __call__(self, stage):
+        now = time.time()
+        self.record[stage] = self.record.get(stage, 0) + now - self.last
+        _profiler.span(stage, self.last, now, path=self.record['path'])
+        self.last = now
+
+    def done(self, **extra):
+        self.record.update(extra)
+        _profiler.files.append(self.record)
+
+class _NullTimer:
+    def __call__(self, stage):
+        pass
+
+    def done(self, **extra):
+        pass
+
+_null_timer = _NullTimer()
+
+def _profiled(handler):
+    stats = _profiler.handler_stats(getattr(handler, 'name', handler.__name__))
+
+    def func(i, line):
+        start = _clock()
+        ret = handler(i, line)
+        stats[3] += _clock() - start
+        stats[0] += 1
+        if ret is not None:
+            stats[1] += 1
+            stats[2] += ret[0]
+        return ret
+
+    return _tagged(func, getattr(handler, 'tags', None))
+
 def _make_path_re(path):
     return "[%s%s]%s" % (path[0].lower(), path[0].upper(), path[1:].replace('\\', '/').replace('/', r"[/\\]"))
 def _make_path_replace_target(path):
     return path.replace('\\', '\\\\') 
 
-def _getProjects(qmake_out):
+# a line read from a .pro and the lines right after it read from the same one, which is what most of them are
+_qmake_input_run_re = re.compile(r'^DEBUG \d+: (?:Project Parser: )?(?P<file>.+?\.pro):\d[^\n]*(?:\nDEBUG \d+: (?:Project Parser: )?(?P=file):\d[^\n]*)*', re.M)
+_qmake_makefile_prefix = '\nDEBUG 1: QMAKE_MAKEFILE === '
+
+def _read_chunks(stream, log = None):
+    """what stream has, as soon as it has it, in chunks of up to _read_chunk bytes; log gets a copy of each"""
+    try:
+        fd = stream.fileno()
+    except (AttributeError, IOError):
+        fd = None
+
+    while True:
+        chunk = os.read(fd, _read_chunk) if fd is not None else stream.read(_read_chunk)
+        if not chunk:
+            break
+        if log:
+            log.write(chunk)
+        yield chunk
+
+def _pro_of(makefile, pending, cwd):
+    """takes the .pro makefile was written for out of pending, the .pro files read but not matched yet
+
+    A subdirs .pro is read before the projects below it are written, so the first one read is not necessarily it:
+    qmake names what it writes after the .pro, in the directory of the .pro unless it is a shadow build.
+    """
+    if not pending:
+        return None
+
+    name = os.path.splitext(os.path.basename(makefile))[0]
+    directory = os.path.normcase(os.path.abspath(os.path.dirname(os.path.join(cwd or '', makefile))))
+    def rank(pro):
+        return (os.path.splitext(os.path.basename(os.path.normcase(pro)))[0] != name,
+                os.path.normcase(os.path.abspath(os.path.dirname(os.path.join(cwd or '', pro)))) != directory)
+
+    # min() keeps the first read among equals
+    pro = min(pending, key=rank)
+    del pending[pro]
+    return pro
+
+def _getProjects(qmake_out, sources = None, log = None, cwd = None):
+    """projects qmake wrote, in order; sources gets the .pro each of them was written for
+
+    The debug output is searched chunk by chunk rather than split into lines, as next to all of it is noise.
+    """
     prev = ()
-    qmake_proj_prefix = "DEBUG 1: QMAKE_MAKEFILE === "
+    pending = collections.OrderedDict()
+    # always starts at a line break, so every line of interest follows one
+    data = '\n'
+
+    for chunk in itertools.chain(_read_chunks(qmake_out, log), ('\n',)):
+        data += chunk
+        last = data.rfind('\n')
+        pos = 0
+        while True:
+            start = data.find(_qmake_makefile_prefix, pos, last)
+            at = pos
+            end = start if start >= 0 else last
+            while sources is not None:
+                match = _qmake_input_run_re.search(data, at, end)
+                if not match:
+                    break
+                pending.setdefault(match.group('file'), True)
+                at = match.end()
+            if start < 0:
+                break
 
-    for line in qmake_out:
-        if line.startswith(qmake_proj_prefix):
             for x in iter(prev):
                 yield x
 
-            proj = os.path.normcase(os.path.normpath(line.replace(qmake_proj_prefix, "", 1).rstrip()))
-            if proj.endswith('.vcxproj'):
-                prev = (proj, proj + '.filters')
-            else:
-                prev = (proj,)
+            pos = data.find('\n', start + 1)
+            prev = (os.path.normcase(os.path.normpath(data[start + len(_qmake_makefile_prefix):pos].rstrip())),)
+            if sources is not None:
+                sources[prev[0]] = _pro_of(prev[0], pending, cwd)
+
+        data = data[last:]
 
     for x in iter(prev):
         yield x
 
-def _loadFile(path, modifier, out):
-    return modifier(map(string.rstrip, codecs.open(path, 'r', 'gbk')), path, out)
+class _CompressedLog:
+    """copy of whatever is written, compressed to gzip, or zstd for a .zst path, on a background thread"""
+
+    def __init__(self, path):
+        if path.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('%s needs the zstandard module, or a .gz name instead' % path)
+            self.file = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        else:
+            self.file = gzip.open(path, 'wb')
+
+        # bounded, so a slow disk holds qmake back rather than filling the memory
+        self.queue = Queue.Queue(64)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        # after an error the queue is still drained, so write() never blocks on a writer that gave up
+        for chunk in iter(self.queue.get, None):
+            if self.error is None:
+                try:
+                    self.file.write(chunk)
+                except Exception as e:
+                    self.error = e
+        try:
+            self.file.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def write(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(chunk)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 def _saveFile(path, content):
-    with codecs.open(path, 'w', 'utf-8') as f:
-        f.write('\r\n'.join(content))
+    with _AtomicFile(path) as f:
+        f.write(_encodeLines(content))
+
+def _readBytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+def _writeBytes(path, content, compare = True):
+    with _AtomicFile(path, compare) as f:
+        f.write(content)
+
+def _replace_file(src, dst):
+    if os.name == 'nt':
+        import ctypes
+        fsencoding = sys.getfilesystemencoding()
+        src, dst = (x if isinstance(x, unicode) else x.decode(fsencoding) for x in (src, dst))
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+        if not ctypes.windll.kernel32.MoveFileExW(src, dst, 0x1 | 0x8):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+# read once while still single threaded: the only way to learn it sets it
+_umask = os.umask(0)
+os.umask(_umask)
+
+class _AtomicFile:
+    """writes to a temporary file beside path and renames it over path once complete, unless nothing changed
+
+    digest is the SHA-1 of what was written, taken as it is written.
+    """
+
+    def __init__(self, path, compare = True):
+        self.path = path
+        self.compare = compare
+        self.replaced = False
+        self.digest = hashlib.sha1()
+
+    def __enter__(self):
+        fd, self.temp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(self.path), dir=os.path.dirname(os.path.abspath(self.path)))
+        self.file = os.fdopen(fd, 'wb')
+        return self
+
+    def write(self, content):
+        self.digest.update(content)
+        self.file.write(content)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.file.close()
+        if exc_type is None:
+            exists = os.path.exists(self.path)
+            if not (exists and self.compare and filecmp.cmp(self.temp, self.path, False)):
+                if exists:
+                    shutil.copymode(self.path, self.temp)
+                else:
+                    # mkstemp makes it private, a new file gets the mode open() would give it
+                    os.chmod(self.temp, 0666 & ~_umask)
+                _replace_file(self.temp, self.path)
+                self.replaced = True
+
+        if not self.replaced:
+            os.remove(self.temp)
+
+_boms = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+_read_chunk = 1 << 20
+
+def _bom_encoding(head):
+    return next((encoding for bom, encoding in _boms if head.startswith(bom)), None)
+
+def _splitLines(text):
+    # unicode.rstrip is a C method, so map runs without a Python call per line
+    return map(unicode.rstrip, text.splitlines())
+
+def _decode(raw):
+    """lines of raw and the encoding they were read with: a BOM's, else UTF-8 if valid, else GBK"""
+    encoding = _bom_encoding(raw)
+    if encoding:
+        return _splitLines(raw.decode(encoding)), encoding
+
+    try:
+        return _splitLines(raw.decode('utf-8')), 'utf-8'
+    except UnicodeDecodeError:
+        return _splitLines(raw.decode('gbk')), 'gbk'
+
+def _decodeLines(raw):
+    return _decode(raw)[0]
+
+def _utf8(raw):
+    """raw as UTF-8 without a BOM, only decoding it when it is in another encoding"""
+    encoding = _bom_encoding(raw)
+    if not encoding:
+        try:
+            raw.decode('utf-8')
+            return raw
+        except UnicodeDecodeError:
+            encoding = 'gbk'
+
+    return raw.decode(encoding).encode('utf-8')
+
+def _sniff_encoding(f):
+    """the encoding _decode would pick for the rest of f, read in chunks; f is rewound"""
+    start = f.tell()
+    encoding = _bom_encoding(f.read(4))
+    f.seek(start)
+    if encoding:
+        return encoding
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(lambda: f.read(_read_chunk), ''):
+            decoder.decode(chunk)
+        decoder.decode('', True)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'gbk'
+    finally:
+        f.seek(start)
+
+def _iterLines(f, encoding):
+    """decoded lines of f, read a chunk at a time"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    tail = u''
+    for chunk in iter(lambda: f.read(_read_chunk), ''):
+        text = tail + decoder.decode(chunk)
+        # a CR at the end of a chunk may be the first half of a CRLF
+        cut = len(text) - 1 if text.endswith(u'\r') else len(text)
+        lines = _splitLines(text[:cut] + u'\0')
+        tail = lines.pop()[:-1] + text[cut:]
+        for line in lines:
+            yield line
+
+    for line in _splitLines(tail + decoder.decode('', True)):
+        yield line
+
+def _encodeLines(content):
+    return u'\r\n'.join(content).encode('utf-8')
+
+# the element a line-anchored handler pattern can only match, e.g. '^(\s*)<(?P<mark>ClCompile) Include=...'
+_leading_tag_re = re.compile(r'^\^(?:\\s[*+]|\(\\s[*+]\)|\(\?P<\w+>\\s[*+]\))<(?:\((?:\?P<\w+>)?)?(\w+)\)?(?=[ >/"]|\\s)')
+_line_tag_re = re.compile(r'\s*<(\w+)')
+
+def _leading_tags(exp):
+    match = _leading_tag_re.match(exp)
+    return frozenset((match.group(1),)) if match else None
+
+def _tagged(func, tags, name = None):
+    func.tags = tags
+    func.name = name or func.__name__
+    return func
+
+def _dispatch_handlers(handlers):
+    """returns line -> handlers, leaving out every handler that can't apply to the line's leading element"""
+    if all(getattr(h, 'tags', None) is None for h in handlers):
+        return lambda line: handlers
+
+    by_tag = {}
+    def lookup(line):
+        match = _line_tag_re.match(line)
+        tag = match.group(1) if match else ''
+        found = by_tag.get(tag)
+        if found is None:
+            found = by_tag[tag] = tuple(h for h in handlers if getattr(h, 'tags', None) is None or tag in h.tags)
+        return found
+
+    return lookup
+
+def _compile_templates(compiled, targets):
+    return tuple(sre_parse.parse_template(t, compiled) for t in targets)
+
+def _expand(match, templates):
+    return (sre_parse.expand_template(t, match) for t in templates)
 
 def _handle_by_regex(exp, targets, skipCurrentLine = True):
     compiled = re.compile(exp)
+    templates = _compile_templates(compiled, targets)
     def func(_, line):
         match = compiled.match(line)
-        return (1 if skipCurrentLine else 0, (match.expand(t) for t in targets)) if match else None
+        return (1 if skipCurrentLine else 0, _expand(match, templates)) if match else None
 
-    return func
+    return _tagged(func, _leading_tags(exp), exp)
 
 def _handle_by_dict(dict):
     def func(_, line):
@@ -88,17 +578,143 @@ def _handle_by_dict(dict):
 
     return func
 
+_element_re = re.compile(r'(\s*)<(/?)([\w:.-]+)(?:\s[^>]*)?>$')
+
+class _RangeIndexer:
+    """pairs every element's opening line with its closing line as lines are fed in order"""
+
+    def __init__(self):
+        self.ranges = {}
+        self.opened = []
+
+    def feed(self, i, line):
+        match = _element_re.match(line)
+        if not match or line.endswith('/>'):
+            return
+
+        indent, closing, mark = match.group(1, 2, 3)
+        if not closing:
+            self.opened.append((indent, mark, i))
+            return
+
+        while self.opened:
+            open_indent, open_mark, start = self.opened.pop()
+            if open_indent == indent and open_mark == mark:
+                self.ranges[start] = i
+                break
+
+def _index_ranges(filelines):
+    indexer = _RangeIndexer()
+    for i, line in enumerate(filelines):
+        indexer.feed(i, line)
+
+    return indexer.ranges
+
+class _IndexedLines(list):
+    """file lines plus the closing line of every element, indexed in a single pass on first use"""
+    _ranges = None
+
+    def close_of(self, i):
+        if self._ranges is None:
+            self._ranges = _index_ranges(self)
+        return self._ranges.get(i)
+
+    def peek(self):
+        return iter(self)
+
+class _LineWindow:
+    """lines pulled lazily from an iterator
+
+    Only the lines between the one being iterated and the furthest line a handler has
+    looked ahead to are kept, and element ranges are paired as lines come in.
+    """
+
+    def __init__(self, lines):
+        self.source = iter(lines)
+        self.lines = collections.deque()
+        self.base = 0
+        self.indexer = _RangeIndexer()
+
+    def _pull(self):
+        line = next(self.source)
+        self.indexer.feed(self.base + len(self.lines), line)
+        self.lines.append(line)
+
+    def _release(self, i):
+        while self.base < i and self.lines:
+            self.lines.popleft()
+            self.indexer.ranges.pop(self.base, None)
+            self.base += 1
+
+    def __getitem__(self, i):
+        if i < self.base:
+            raise IndexError('line %d was already released' % i)
+
+        try:
+            while self.base + len(self.lines) <= i:
+                self._pull()
+        except StopIteration:
+            raise IndexError('line %d is past the end of file' % i)
+
+        return self.lines[i - self.base]
+
+    def __iter__(self):
+        i = self.base
+        while True:
+            self._release(i)
+            try:
+                line = self[i]
+            except IndexError:
+                return
+            yield line
+            i += 1
+
+    def peek(self):
+        i = self.base
+        while True:
+            try:
+                line = self[i]
+            except IndexError:
+                return
+            yield line
+            i += 1
+
+    def close_of(self, i):
+        ranges = self.indexer.ranges
+        try:
+            while i not in ranges:
+                self._pull()
+        except StopIteration:
+            return None
+
+        return ranges[i]
+
+    def index(self, value, start):
+        i = start
+        try:
+            while self[i] != value:
+                i += 1
+        except IndexError:
+            raise ValueError('%r is not in the file' % value)
+
+        return i
+
 def _handle_remove_range_with_detail(filelines, exp):
-    compiled = re.compile(exp);
+    compiled = re.compile(exp)
+    exp = compiled.pattern
 
     def func(i, line):
         match = compiled.match(line)
         if not match:
             return 0, match
 
-        stop = filelines.index(match.expand('\\g<indent></\\g<mark>>'), i)
+        stop = filelines.close_of(i)
+        if stop is None:
+            stop = filelines.index(match.expand('\\g<indent></\\g<mark>>'), i)
         return stop - i + 1, match
-    return func
+
+    func.pattern = compiled
+    return _tagged(func, _leading_tags(exp), exp)
 
 def _handle_remove_range(filelines, exp):
     with_detail = _handle_remove_range_with_detail(filelines, exp)
@@ -106,7 +722,7 @@ def _handle_remove_range(filelines, exp):
     def func(i, line):
         skip = with_detail(i, line)[0]
         return (skip, ()) if skip else None
-    return func
+    return _tagged(func, with_detail.tags, 'remove ' + with_detail.name)
 
 def _handle_once(target_func):
     used = [False]
@@ -119,7 +735,7 @@ def _handle_once(target_func):
         used[0] = result is not None
         return result
 
-    return func
+    return _tagged(func, getattr(target_func, 'tags', None), 'once ' + getattr(target_func, 'name', target_func.__name__))
 
 def _handle_list(list_exp, handlers, sep = ';'):
     compiled = re.compile(list_exp)
@@ -133,7 +749,7 @@ def _handle_list(list_exp, handlers, sep = ';'):
         new_list = _execute_handler_alllines(old_list.split(sep), handlers + (append_line,))
         return (1, (line.replace(old_list, sep.join(new_list), 1),))
 
-    return func
+    return _tagged(func, _leading_tags(list_exp), list_exp)
 
 def _execute_handler(i, line, handlers):
     skip = 0
@@ -149,80 +765,111 @@ def _execute_handler(i, line, handlers):
 
     return (skip, retLines) if skip != 0 or len(retLines) > 0 else None
 
-def _execute_handler_alllines(filelines, handlers):
-    ret = []
+def _iter_handler_alllines(filelines, handlers):
+    if options.profile:
+        handlers = tuple(_profiled(h) for h in handlers)
+
+    lookup = _dispatch_handlers(handlers)
     skip = 0
-    for i in xrange(0, len(filelines)):
+    for i, line in enumerate(filelines):
         if skip == 0:
-            skip, lines = _execute_handler(i, filelines[i], handlers)
-            ret += lines
+            skip, lines = _execute_handler(i, line, lookup(line))
+            for l in lines:
+                yield l
 
         skip = skip - 1
 
-    return ret
+def _execute_handler_alllines(filelines, handlers):
+    return list(_iter_handler_alllines(filelines, handlers))
+
+_cl_compile_range_re = re.compile(r'^(?P<indent>\s+)<(?P<mark>ClCompile) Include="(?P<file>.+)">$')
+_custom_build_range_re = re.compile(r'^(?P<indent>\s+)<(?P<mark>CustomBuild) Include="(?P<file>.+)">$')
+_precompiled_header_source_re = re.compile(r'^(\s+)<PrecompiledHeader Condition=".*">Create</PrecompiledHeader>$')
+_rcc_input_re = re.compile(r'^(\s+)<AdditionalInputs Condition=".+">.*rcc\.exe;.*</AdditionalInputs>$')
+
+# (line offset into the CustomBuild block, rule, replacement, marks the pch source generation)
+_custom_build_rules = (
+    (2, _rcc_input_re, _compile_templates(_custom_build_range_re, ('\\g<indent><QtQrc Include="\\g<file>" />',)), False),
+    (1, re.compile(r'^(\s+)<AdditionalInputs Condition=".+">.*moc\.exe;.*</AdditionalInputs>$'), _compile_templates(_custom_build_range_re, ('\\g<indent><ClInclude Include="\\g<file>" />',)), False),
+    (2, re.compile(r'^(\s+)<Message Condition=".+">Generating precompiled header source file.*</Message>$'), _compile_templates(_custom_build_range_re, (
+        '\\g<indent><ClInclude Include="\\g<file>">',
+        '\\g<indent>  <PrecompiledHeader>Create</PrecompiledHeader>',
+        '\\g<indent></ClInclude>',
+    )), True),
+)
+
+# appended before </Project> once a pch source CustomBuild became a ClInclude: the hook, then the targets it runs
+_precompiled_header_source_hook = (
+    '  <PropertyGroup>',
+    '    <BeforeClCompileTargets>',
+    '      $(BeforeClCompileTargets);',
+    '      _GeneratePrecompiledHeaderSource;',
+    '    </BeforeClCompileTargets>',
+    '    <CppCleanDependsOn>',
+    '      _GeneratePrecompiledHeaderSource_Clean;',
+    '      $(CppCleanDependsOn);',
+    '    </CppCleanDependsOn>',
+    '  </PropertyGroup>',
+)
+
+_precompiled_header_source_rules = (
+    '  <Target Name="_GeneratePrecompiledHeaderSource"',
+    '          DependsOnTargets="_GeneratePrecompiledHeaderSource_Filter;_GeneratePrecompiledHeaderSource_Create" />',
+    '  <Target Name="_GeneratePrecompiledHeaderSource_Filter">',
+    '    <ItemGroup>',
+    '      <PrecompiledHeaderSource Include="@(ClInclude)" Condition="\'%(ClInclude.PrecompiledHeader)\' == \'Create\'">',
+    '        <PrecompiledHeaderSourceFile>$(IntDir)%(Filename)%(Extension)$(DefaultLanguageSourceExtension)</PrecompiledHeaderSourceFile>',
+    '      </PrecompiledHeaderSource>',
+    '      <ClCompile Include="@(PrecompiledHeaderSource->\'%(PrecompiledHeaderSourceFile)\')" />',
+    '    </ItemGroup>',
+    '  </Target>',
+    '  <Target Name="_GeneratePrecompiledHeaderSource_Create"',
+    '          Inputs="@(PrecompiledHeaderSource)"',
+    '          Outputs="%(PrecompiledHeaderSource.PrecompiledHeaderSourceFile)">',
+    '    <ItemGroup>',
+    '      <PrecompiledHeaderSourceContent Include="/%2A--------------------------------------------------------------------" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A Precompiled header source file used by Visual Studio.NET to generate" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A the .pch file." />',
+    '      <PrecompiledHeaderSourceContent Include="%2A" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A Due to issues with the dependencies checker within the IDE, it" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A sometimes fails to recompile the PCH file, if we force the IDE to" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A create the PCH file directly from the header file." />',
+    '      <PrecompiledHeaderSourceContent Include="%2A" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A This file is auto-generated by qmake since no PRECOMPILED_SOURCE was" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A specified, and is used as the common stdafx.cpp. The file is only" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A generated when creating .vcxproj project files, and is not used for" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A command line compilations by nmake." />',
+    '      <PrecompiledHeaderSourceContent Include="%2A" />',
+    '      <PrecompiledHeaderSourceContent Include="%2A WARNING: All changes made in this file will be lost." />',
+    '      <PrecompiledHeaderSourceContent Include="--------------------------------------------------------------------%2A/" />',
+    '      <PrecompiledHeaderSourceContent Include="#include &quot;$([MSBuild]::MakeRelative($(ProjectDir)$(IntDir), $(ProjectDir)%(PrecompiledHeaderSource.Identity)))&quot;" />',
+    '    </ItemGroup>',
+    '    <WriteLinesToFile File="%(PrecompiledHeaderSource.PrecompiledHeaderSourceFile)"',
+    '                      Lines="@(PrecompiledHeaderSourceContent)"',
+    '                      Overwrite="true" />',
+    '    <ItemGroup>',
+    '      <PrecompiledHeaderSourceContent Remove="@(PrecompiledHeaderSourceContent)" />',
+    '    </ItemGroup>',
+    '  </Target>',
+    '  <Target Name="_GeneratePrecompiledHeaderSource_Clean" DependsOnTargets="_GeneratePrecompiledHeaderSource_Filter">',
+    '    <Delete Files="@(PrecompiledHeaderSource->\'%(PrecompiledHeaderSourceFile)\')" />',
+    '  </Target>',
+)
+
+def _generated_targets(hook, rules):
+    """the lines a project gets to run generated targets; with --shared-props their rules are in the shared sheet"""
+    return hook if options.shared_props else hook + rules
 
 def _handle_custom_build(filelines):
     moreHandler = []
 
     _generate_precompiled_header_source = []
 
-    clCompileRangeChecker = _handle_remove_range_with_detail(filelines, r'^(?P<indent>\s+)<(?P<mark>ClCompile) Include="(?P<file>.+)">$')
-    precompiledHeaderSourceChecker = re.compile(r'^(\s+)<PrecompiledHeader Condition=".*">Create</PrecompiledHeader>$')
+    clCompileRangeChecker = _handle_remove_range_with_detail(filelines, _cl_compile_range_re)
+    precompiledHeaderSourceChecker = _precompiled_header_source_re
     def _handle_generate_precompiled_header_source(i, line):
         if line == end_project:
-            return (0, (
-                '  <PropertyGroup>',
-                '    <BeforeClCompileTargets>',
-                '      $(BeforeClCompileTargets);',
-                '      _GeneratePrecompiledHeaderSource;',
-                '    </BeforeClCompileTargets>',
-                '    <CppCleanDependsOn>',
-                '      _GeneratePrecompiledHeaderSource_Clean;',
-                '      $(CppCleanDependsOn);',
-                '    </CppCleanDependsOn>',
-                '  </PropertyGroup>',
-                '  <Target Name="_GeneratePrecompiledHeaderSource"',
-                '          DependsOnTargets="_GeneratePrecompiledHeaderSource_Filter;_GeneratePrecompiledHeaderSource_Create" />',
-                '  <Target Name="_GeneratePrecompiledHeaderSource_Filter">',
-                '    <ItemGroup>',
-                '      <PrecompiledHeaderSource Include="@(ClInclude)" Condition="\'%(ClInclude.PrecompiledHeader)\' == \'Create\'">',
-                '        <PrecompiledHeaderSourceFile>$(IntDir)%(Filename)%(Extension)$(DefaultLanguageSourceExtension)</PrecompiledHeaderSourceFile>',
-                '      </PrecompiledHeaderSource>',
-                '      <ClCompile Include="@(PrecompiledHeaderSource->\'%(PrecompiledHeaderSourceFile)\')" />',
-                '    </ItemGroup>',
-                '  </Target>',
-                '  <Target Name="_GeneratePrecompiledHeaderSource_Create"',
-                '          Inputs="@(PrecompiledHeaderSource)"',
-                '          Outputs="%(PrecompiledHeaderSource.PrecompiledHeaderSourceFile)">',
-                '    <ItemGroup>',
-                '      <PrecompiledHeaderSourceContent Include="/%2A--------------------------------------------------------------------" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A Precompiled header source file used by Visual Studio.NET to generate" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A the .pch file." />',
-                '      <PrecompiledHeaderSourceContent Include="%2A" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A Due to issues with the dependencies checker within the IDE, it" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A sometimes fails to recompile the PCH file, if we force the IDE to" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A create the PCH file directly from the header file." />',
-                '      <PrecompiledHeaderSourceContent Include="%2A" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A This file is auto-generated by qmake since no PRECOMPILED_SOURCE was" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A specified, and is used as the common stdafx.cpp. The file is only" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A generated when creating .vcxproj project files, and is not used for" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A command line compilations by nmake." />',
-                '      <PrecompiledHeaderSourceContent Include="%2A" />',
-                '      <PrecompiledHeaderSourceContent Include="%2A WARNING: All changes made in this file will be lost." />',
-                '      <PrecompiledHeaderSourceContent Include="--------------------------------------------------------------------%2A/" />',
-                '      <PrecompiledHeaderSourceContent Include="#include &quot;$([MSBuild]::MakeRelative($(ProjectDir)$(IntDir), $(ProjectDir)%(PrecompiledHeaderSource.Identity)))&quot;" />',
-                '    </ItemGroup>',
-                '    <WriteLinesToFile File="%(PrecompiledHeaderSource.PrecompiledHeaderSourceFile)"',
-                '                      Lines="@(PrecompiledHeaderSourceContent)"',
-                '                      Overwrite="true" />',
-                '    <ItemGroup>',
-                '      <PrecompiledHeaderSourceContent Remove="@(PrecompiledHeaderSourceContent)" />',
-                '    </ItemGroup>',
-                '  </Target>',
-                '  <Target Name="_GeneratePrecompiledHeaderSource_Clean" DependsOnTargets="_GeneratePrecompiledHeaderSource_Filter">',
-                '    <Delete Files="@(PrecompiledHeaderSource->\'%(PrecompiledHeaderSourceFile)\')" />',
-                '  </Target>',
-            ))
+            return (0, _generated_targets(_precompiled_header_source_hook, _precompiled_header_source_rules))
 
         skip, match = clCompileRangeChecker(i, line)
         return (skip, ()) if skip > 4 and precompiledHeaderSourceChecker.match(filelines[i + 3]) else None
@@ -232,40 +879,420 @@ def _handle_custom_build(filelines):
             _generate_precompiled_header_source.append(True)
             moreHandler.append(_handle_generate_precompiled_header_source)
 
-    rangeChecker = _handle_remove_range_with_detail(filelines, r'^(?P<indent>\s+)<(?P<mark>CustomBuild) Include="(?P<file>.+)">$')
-    customBuildHandler = (
-        (2, re.compile(r'^(\s+)<AdditionalInputs Condition=".+">.*rcc\.exe;.*</AdditionalInputs>$'), ('\\g<indent><QtQrc Include="\\g<file>" />',), None),
-        (1, re.compile(r'^(\s+)<AdditionalInputs Condition=".+">.*moc\.exe;.*</AdditionalInputs>$'), ('\\g<indent><ClInclude Include="\\g<file>" />',), None),
-        (2, re.compile(r'^(\s+)<Message Condition=".+">Generating precompiled header source file.*</Message>$'), (
-            '\\g<indent><ClInclude Include="\\g<file>">',
-            '\\g<indent>  <PrecompiledHeader>Create</PrecompiledHeader>',
-            '\\g<indent></ClInclude>',
-        ), _mark_generate_precompiled_header_source),
-    )
+    rangeChecker = _handle_remove_range_with_detail(filelines, _custom_build_range_re)
 
     def func(i, line):
         skip, match = rangeChecker(i, line)
         if skip != 0:
-            for h in customBuildHandler:
-                offset, rule, replacement, f = h
+            for h in _custom_build_rules:
+                offset, rule, replacement, marks_pch = h
                 if rule.match(filelines[i + offset]):
-                    if f:
-                        f(i, line)
+                    if marks_pch:
+                        _mark_generate_precompiled_header_source(i, line)
 
-                    return (skip, (match.expand(t) for t in replacement))
+                    return (skip, _expand(match, replacement))
 
         return _execute_handler(i, line, moreHandler)
 
-    return func
+    # moreHandler only ever acts on ClCompile blocks and the closing </Project>
+    return _tagged(func, frozenset(('CustomBuild', 'ClCompile', '')), '_handle_custom_build')
+
+_unity_item_re = re.compile(r'^\s*<ClCompile Include="([^"]*)"\s*/>\r?$', re.M)
+_unity_source_re = re.compile(r'^(?P<indent>\s*)<ClCompile Include="(?P<file>[^"]*)"\s*/>$')
+_unity_extensions = ('.cpp', '.cc', '.cxx', '.c++')
+# anonymous namespaces collide once sources share a translation unit, and moc output a source includes is only built for sources of their own
+_unity_unsafe_re = re.compile(r'\bnamespace\s*\{|^\s*#\s*include\s*["<](?:[^">]*\.moc|moc_[^">]*\.cpp)[">]', re.M)
+
+# inserted before the ExtensionTargets of a project whose sources were bundled
+_unity_hook = (
+    '  <PropertyGroup>',
+    '    <BeforeClCompileTargets>',
+    '      $(BeforeClCompileTargets);',
+    '      _GenerateUnitySource;',
+    '    </BeforeClCompileTargets>',
+    '    <CppCleanDependsOn>',
+    '      _GenerateUnitySource_Clean;',
+    '      $(CppCleanDependsOn);',
+    '    </CppCleanDependsOn>',
+    '  </PropertyGroup>',
+)
+
+_unity_rules = (
+    '  <Target Name="_GenerateUnitySource"',
+    '          DependsOnTargets="_GenerateUnitySource_Filter;_GenerateUnitySource_Create" />',
+    '  <Target Name="_GenerateUnitySource_Filter">',
+    '    <ItemGroup>',
+    '      <UnitySource Include="@(ClCompile)" Condition="\'%(ClCompile.UnityBundle)\' != \'\'">',
+    '        <UnitySourceFile>$(IntDir)unity_$(ProjectName)_%(ClCompile.UnityBundle)$(DefaultLanguageSourceExtension)</UnitySourceFile>',
+    '      </UnitySource>',
+    '    </ItemGroup>',
+    '    <RemoveDuplicates Inputs="@(UnitySource->\'%(UnitySourceFile)\')">',
+    '      <Output TaskParameter="Filtered" ItemName="UnityBundleSource" />',
+    '    </RemoveDuplicates>',
+    '    <ItemGroup>',
+    '      <ClCompile Include="@(UnityBundleSource)">',
+    '        <UnityBundle></UnityBundle>',
+    '        <ExcludedFromBuild>false</ExcludedFromBuild>',
+    '      </ClCompile>',
+    '    </ItemGroup>',
+    '  </Target>',
+    '  <Target Name="_GenerateUnitySource_Create"',
+    '          Inputs="$(MSBuildProjectFullPath)"',
+    '          Outputs="%(UnitySource.UnitySourceFile)">',
+    '    <PropertyGroup>',
+    '      <UnitySourcePrecompiledHeader Condition="\'%(UnitySource.PrecompiledHeader)\' == \'Use\'">%(UnitySource.PrecompiledHeaderFile)</UnitySourcePrecompiledHeader>',
+    '    </PropertyGroup>',
+    '    <ItemGroup>',
+    '      <UnitySourceContent Include="#include &quot;$(UnitySourcePrecompiledHeader)&quot;" Condition="\'$(UnitySourcePrecompiledHeader)\' != \'\'" />',
+    '      <UnitySourceContent Include="#include &quot;$([MSBuild]::MakeRelative($(ProjectDir)$(IntDir), $(ProjectDir)%(UnitySource.Identity)))&quot;" />',
+    '    </ItemGroup>',
+    '    <WriteLinesToFile File="%(UnitySource.UnitySourceFile)"',
+    '                      Lines="@(UnitySourceContent)"',
+    '                      Overwrite="true" />',
+    '    <ItemGroup>',
+    '      <UnitySourceContent Remove="@(UnitySourceContent)" />',
+    '    </ItemGroup>',
+    '    <PropertyGroup>',
+    '      <UnitySourcePrecompiledHeader />',
+    '    </PropertyGroup>',
+    '  </Target>',
+    '  <Target Name="_GenerateUnitySource_Clean" DependsOnTargets="_GenerateUnitySource_Filter">',
+    '    <Delete Files="@(UnityBundleSource)" />',
+    '  </Target>',
+)
+
+def _unity_sources(path, out):
+    """(include, file) of every source the project could bundle: plain C++ ClCompile items without settings of their own"""
+    raw = _readBytes(path)
+    if raw is None:
+        return ()
+
+    base = os.path.dirname(out)
+    includes = (include.decode('utf-8') for include in _unity_item_re.findall(_utf8(raw)))
+    return tuple((include, _item_path(base, include)) for include in includes
+                 if os.path.splitext(include)[1].lower() in _unity_extensions and '$(' not in include and '@(' not in include)
+
+def _unity_plan(path, out):
+    """include -> bundle of the sources to bundle, split into options.unity bundles of about the same size
+
+    Sources are taken in directory order, so a bundle mostly holds neighbours sharing their headers.
+    Bundles left with a single source are not worth it and keep it as it is.
+    """
+    sources = []
+    for include, source in _unity_sources(path, out):
+        raw = _readBytes(source)
+        if raw is not None and not _unity_unsafe_re.search(raw):
+            sources.append((include.lower().replace('/', '\\').rpartition('\\'), include, len(raw)))
+    sources.sort()
+
+    count = min(options.unity, len(sources) // 2)
+    if count < 1:
+        return {}
+
+    plan = {}
+    target = sum(size for key, include, size in sources) / float(count)
+    done = 0
+    for key, include, size in sources:
+        plan[include] = min(count - 1, int((done + size / 2.0) / target)) if target else 0
+        done += size
+
+    members = collections.Counter(plan.itervalues())
+    return dict((include, bundle) for include, bundle in plan.iteritems() if members[bundle] > 1)
+
+def _handle_unity(filelines, plan):
+    def func(i, line):
+        match = _unity_source_re.match(line)
+        if match and match.group('file') in plan:
+            indent = match.group('indent')
+            return (1, (
+                '%s<ClCompile Include="%s">' % (indent, match.group('file')),
+                '%s  <UnityBundle>%d</UnityBundle>' % (indent, plan[match.group('file')]),
+                '%s  <ExcludedFromBuild>true</ExcludedFromBuild>' % indent,
+                '%s</ClCompile>' % indent,
+            ))
 
-def _is_qt_enabled(filelines, path):
-    additionalIncludeDirectoriesRe = re.compile(r'^\s*<AdditionalIncludeDirectories>(.*)</AdditionalIncludeDirectories>$')
+        return (0, _generated_targets(_unity_hook, _unity_rules)) if line.lstrip().startswith('<ImportGroup Label="ExtensionTargets"') else None
+
+    return _tagged(func, frozenset(('ClCompile', 'ImportGroup')), '_handle_unity')
+
+def _compile_sources(path, out):
+    """(include, file) of every ClCompile item of a project naming a file of its own"""
+    raw = _readBytes(path)
+    if raw is None:
+        return ()
+
+    base = os.path.dirname(out)
+    return tuple(sorted((include, _item_path(base, include)) for include, mark in _raw_items(raw).iteritems()
+                        if mark == 'ClCompile' and '$(' not in include and '@(' not in include))
+
+_precompiled_header_re = re.compile(r'<PrecompiledHeader[ >]')
+_prologue_include_re = re.compile(r'#\s*include\s*(<[^>]+>|"[^"]*")')
+# rough cost of parsing one more Qt or system header, only used to report what --auto-pch saves
+_auto_pch_parse_seconds = 0.05
+
+def _include_prologue(path):
+    """the headers a source includes ahead of any other code as written, <...> or "...", or None when it can't be read"""
+    raw = _readBytes(path)
+    if raw is None:
+        return None
+
+    headers = []
+    comment = False
+    for line in _utf8(raw).splitlines():
+        line = line.strip()
+        if comment:
+            comment = '*/' not in line
+            continue
+        if not line or line.startswith('//') or line == '#pragma once':
+            continue
+        if line.startswith('/*'):
+            comment = '*/' not in line[2:]
+            continue
+
+        match = _prologue_include_re.match(line)
+        if not match:
+            break
+        headers.append(match.group(1).decode('utf-8'))
+
+    return headers
+
+def _auto_pch_header(out):
+    return os.path.splitext(out)[0] + '_pch.h'
+
+def _auto_pch_plan(path, out):
+    """(headers to precompile in include order, includes of the sources using them, sources scanned), or None
+
+    Only projects without any precompiled header setting and without C sources qualify. The prologues of their
+    sources are kept in the cure cache and only scanned again once a source's mtime or size changed.
+    """
+    raw = _readBytes(path)
+    if raw is None or _precompiled_header_re.search(raw):
+        return None
+
+    files = dict(_compile_sources(path, out))
+    if any(os.path.splitext(include)[1].lower() == '.c' for include in files):
+        return None
+
+    stamps = _stamps(files.itervalues())
+    entry = _json_entry('prologues', out)
+    table = _load_json(entry) or {}
+    stale = [include for include, source in files.iteritems()
+             if stamps[source] and (include not in table or table[include][0] != list(stamps[source]))]
+    for include, headers in zip(stale, _scan_pool().map(lambda include: _include_prologue(files[include]), stale)):
+        if headers is not None:
+            table[include] = [list(stamps[files[include]]), headers]
+
+    table = dict((include, table[include]) for include, source in files.iteritems() if stamps[source] and include in table)
+    if entry:
+        _store_json(entry, table)
+    if len(table) < options.auto_pch_min_sources:
+        return None
+
+    # force-including headers a source already includes first, in that order, doesn't change its meaning;
+    # so the headers are the longest run of <...> ones enough sources start with, and only those sources use them
+    chosen = []
+    users = sorted((include, headers) for include, (stamp, headers) in table.iteritems())
+    while True:
+        n = len(chosen)
+        counts = collections.Counter(headers[n] for include, headers in users if len(headers) > n and headers[n].startswith('<'))
+        header, count = min(counts.iteritems(), key=lambda item: (-item[1], item[0])) if counts else (None, 0)
+        if count < 2 or count < options.auto_pch * len(table):
+            break
+        chosen.append(header)
+        users = [(include, headers) for include, headers in users if len(headers) > n and headers[n] == header]
+
+    return (chosen, frozenset(include for include, headers in users), len(table)) if chosen else None
+
+def _write_auto_pch(out, headers, users, scanned):
+    lines = [
+        u'/* Precompiled header generated by qmake2.py --auto-pch from the headers the sources using it include first.',
+        u' *',
+        u' * WARNING: All changes made in this file will be lost.',
+        u' */',
+        u'#pragma once',
+    ] + [u'#include %s' % header for header in headers]
+    with _AtomicFile(_auto_pch_header(out)) as f:
+        f.write(_encodeLines(lines))
+
+    if f.replaced:
+        saved = (len(users) - 1) * len(headers)
+        _report(u'Precompiled %d headers %d of %d sources of %s start with: %d fewer header parses, about %.1fs per build' % (len(headers), len(users), scanned, out, saved, saved * _auto_pch_parse_seconds))
+
+def _auto_pch_metadata(header):
+    return (
+        '<PrecompiledHeader>Use</PrecompiledHeader>',
+        '<PrecompiledHeaderFile>$(ProjectDir)%s</PrecompiledHeaderFile>' % header,
+        '<ForcedIncludeFiles>$(ProjectDir)%s;%%(ForcedIncludeFiles)</ForcedIncludeFiles>' % header,
+    )
+
+def _auto_pch_items(header):
+    # the generated pch source is a copy of this item, metadata and all
+    return (
+        '  <ItemGroup>',
+        '    <ClInclude Include="%s">' % header,
+        '      <PrecompiledHeader>Create</PrecompiledHeader>',
+    ) + tuple('      ' + line for line in _auto_pch_metadata(header)[1:]) + (
+        '    </ClInclude>',
+        '  </ItemGroup>',
+    )
+
+_auto_pch_source_re = re.compile(r'^(?P<indent>\s*)<ClCompile Include="(?P<file>[^"]*)"\s*(?P<empty>/?)>$')
+
+def _handle_auto_pch(filelines, header, users):
+    """wires the generated header in the way a pch source CustomBuild of qmake ends up, and has users use it"""
+    items = _auto_pch_items(header)
+    metadata = _auto_pch_metadata(header)
+
+    def func(i, line):
+        match = _auto_pch_source_re.match(line)
+        if match:
+            if match.group('file') not in users:
+                return None
+            indent = match.group('indent')
+            if match.group('empty'):
+                return (1, ('%s<ClCompile Include="%s">' % (indent, match.group('file')),) +
+                           tuple('%s  %s' % (indent, item) for item in metadata) + ('%s</ClCompile>' % indent,))
+            return (1, (line,) + tuple('%s  %s' % (indent, item) for item in metadata))
+
+        line = line.strip()
+        if line == '<Import Project="$(VCTargetsPath)\\Microsoft.Cpp.targets" />':
+            return (0, items)
+        if line.startswith('<ImportGroup Label="ExtensionTargets"'):
+            return (0, _generated_targets(_precompiled_header_source_hook, _precompiled_header_source_rules))
+        return None
+
+    return _tagged(func, frozenset(('ClCompile', 'Import', 'ImportGroup')), '_handle_auto_pch')
+
+def _qrc_files(qrc):
+    """resource files a .qrc lists, resolved against its directory, or None when only rcc can tell"""
+    base = os.path.dirname(qrc)
+    files = []
+    try:
+        for event, element in xml.etree.cElementTree.iterparse(qrc):
+            if element.tag == 'file' and element.text:
+                path = os.path.normpath(os.path.join(base, element.text.strip()))
+                # rcc expands a directory into whatever it holds when it runs
+                if os.path.isdir(path):
+                    return None
+                files.append(path)
+                element.clear()
+    except (IOError, SyntaxError):
+        return None
+
+    return files
+
+def _qrc_inputs(qrc):
+    """_qrc_files of qrc, parsed again only once its mtime or size changed"""
+    stamp = _stamps((qrc,))[qrc]
+    if stamp is None:
+        return None
+
+    entry = _json_entry('qrc', qrc)
+    cached = _load_json(entry)
+    if cached and cached[0] == list(stamp):
+        return cached[1]
+
+    files = _qrc_files(qrc)
+    if entry:
+        _store_json(entry, [list(stamp), files])
+    return files
+
+def _handle_qrc_inputs(filelines, base):
+    """turns an rcc CustomBuild into a QtQrc item listing the resources of its .qrc, so unchanged resources never run rcc"""
+    def func(i, line):
+        match = _custom_build_range_re.match(line)
+        if not match or not match.group('file').lower().endswith('.qrc'):
+            return None
+
+        stop = filelines.close_of(i)
+        if stop is None:
+            stop = filelines.index(match.expand('\\g<indent></\\g<mark>>'), i)
+        if not any(_rcc_input_re.match(filelines[k]) for k in xrange(i + 1, stop)):
+            return None
+
+        files = _qrc_inputs(_item_path(base, match.group('file')))
+        if not files:
+            return None
+
+        indent = match.group('indent')
+        return (stop - i + 1, (
+            '%s<QtQrc Include="%s">' % (indent, match.group('file')),
+            '%s  <InputFiles>%s</InputFiles>' % (indent, xml.sax.saxutils.escape(';'.join(_relative(f, base).replace('/', '\\') for f in files))),
+            '%s</QtQrc>' % indent,
+        ))
+
+    return _tagged(func, frozenset(('CustomBuild',)), '_handle_qrc_inputs')
+
+def _vcxproj_stamps(path, out):
+    """(scan, files): scan is given every line of the project as UTF-8, files then lists what besides it shapes its cure
+
+    Collected a line at a time, so a streamed cure never holds the whole project.
+    """
+    base = os.path.dirname(out)
+    items = set()
+    dirs = set()
+    compiles = options.unity or options.auto_pch
+
+    def scan(line):
+        match = _item_re.match(line)
+        if match:
+            mark, include = match.groups()
+            if (mark == 'CustomBuild' and include.lower().endswith('.qrc')) or (compiles and mark == 'ClCompile' and '$(' not in include and '@(' not in include):
+                items.add(_item_path(base, _utf8(include).decode('utf-8')))
+        elif options.drop_missing_dirs:
+            match = _search_dirs_re.match(line)
+            if match:
+                dirs.update(_item_path(base, entry.strip('"')) for entry in _utf8(match.group(1)).decode('utf-8').split(';')
+                            if entry and '$(' not in entry and '%(' not in entry)
+
+    def files():
+        sheets = [os.path.join(_shared_root(out), name) for name in _shared_sheet_names] if options.shared_props else []
+        return sorted(items) + sorted(dirs) + ([_auto_pch_header(out)] if options.auto_pch else []) + sheets
+
+    return scan, files
+
+def _lru_cache(maxsize):
+    """memoizes a function of hashable arguments, keeping the maxsize most recently used results"""
+    def decorator(func):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+
+        def wrapper(*args):
+            with lock:
+                if args in cache:
+                    cache[args] = result = cache.pop(args)
+                    return result
+
+            result = func(*args)
+            with lock:
+                cache[args] = result
+                if len(cache) > maxsize:
+                    cache.popitem(False)
+            return result
+
+        wrapper.cache = cache
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    return decorator
+
+def _info_key():
+    return tuple(sorted(vars(globalInfo).iteritems()))
+
+_additional_include_directories_re = re.compile(r'^\s*<AdditionalIncludeDirectories>(.*)</AdditionalIncludeDirectories>$')
+
+@_lru_cache(256)
+def _qt_path_patterns(directory, info):
     qt_drive, _ = os.path.splitdrive(globalInfo.path)
-    path_drive, _ = os.path.splitdrive(path)
-    cur_qt_path_re = (r'(%s|%s)' % (globalInfo.path_re, _make_path_re(os.path.relpath(globalInfo.path, os.path.dirname(path))))) if qt_drive == path_drive else (r'(%s)' % globalInfo.path_re)
-    qtRe = re.compile(r'^("?)%s[\\/]include[\\/]Qt(\w+)\1$' % cur_qt_path_re)
+    path_drive, _ = os.path.splitdrive(directory)
+    cur_qt_path_re = (r'(%s|%s)' % (globalInfo.path_re, _make_path_re(os.path.relpath(globalInfo.path, directory)))) if qt_drive == path_drive else (r'(%s)' % globalInfo.path_re)
+    return cur_qt_path_re, re.compile(r'^("?)%s[\\/]include[\\/]Qt(\w+)\1$' % cur_qt_path_re)
+
+def _is_qt_enabled(filelines, path):
+    cur_qt_path_re, qtRe = _qt_path_patterns(os.path.dirname(path), _info_key())
 
-    return (map(lambda x: x.group(3), filter(None, (qtRe.match(x) for x in filter(None, (additionalIncludeDirectoriesRe.match(x) for x in filelines))[0].group(1).split(';')))), cur_qt_path_re)
+    additionalIncludeDirectories = next(m for m in (_additional_include_directories_re.match(x) for x in filelines.peek()) if m)
+    return (map(lambda x: x.group(3), filter(None, (qtRe.match(x) for x in additionalIncludeDirectories.group(1).split(';')))), cur_qt_path_re)
 
 def append_line(_, line):
     return (1, (line,))
@@ -273,7 +1300,204 @@ def append_line(_, line):
 def eat_line(_, line):
     return (1, ())
 
-def _cure_vcxproj(filelines, path, out):
+def _shared(handler):
+    """factory for a stateless handler, shared by every project"""
+    return lambda filelines: handler
+
+def _per_project(factory, *args):
+    """factory for a handler bound to one project's lines or state"""
+    func = lambda filelines: factory(filelines, *args)
+    func.per_project = True
+    return func
+
+def _per_project_once(handler):
+    return _per_project(lambda filelines: _handle_once(handler))
+
+_include_dirs_exp = r'^\s*<AdditionalIncludeDirectories>(?P<list>.*)</AdditionalIncludeDirectories>$'
+_library_dirs_exp = r'^\s*<AdditionalLibraryDirectories>(?P<list>.*)</AdditionalLibraryDirectories>$'
+_dependencies_exp = r'^\s*<AdditionalDependencies>(?P<list>.*)</AdditionalDependencies>$'
+_search_dirs_re = re.compile(r'^\s*<Additional(?:Include|Library)Directories>(.*)</Additional(?:Include|Library)Directories>\r?$', re.M)
+
+# handlers of path lists, and whether their entries are directories
+_search_path_lists = {
+    'include_dirs': True,
+    'library_dirs': True,
+    'dependencies': False,
+}
+
+# where the build writes, into directories qmake leaves to it to create (MOC_DIR, UI_DIR, OBJECTS_DIR, debug, release)
+_output_dirs_re = re.compile(r'^\s*<(IntDir|OutDir|Outputs)\b[^>]*>(.*)</\1>\r?$', re.M)
+
+class _SearchPaths:
+    """canonicalizes the path lists of one project and drops the entries naming a path already listed"""
+
+    def __init__(self, base, path = None):
+        self.base = base
+        self.path = path
+        self.outputs = None
+        self.removed = 0
+
+    def _canonical(self, entry):
+        """(entry as written back, key comparing equal for every spelling of the same path)"""
+        quoted = len(entry) > 1 and entry[0] == entry[-1] == '"'
+        value = entry[1:-1] if quoted else entry
+        if not value or '$(' in value or '%(' in value or '@(' in value:
+            return entry, entry
+
+        value = ntpath.normpath(value.replace('/', '\\'))
+        if value[1:2] == ':':
+            value = value[0].upper() + value[1:]
+        return ('"%s"' % value if quoted else value), ntpath.normcase(ntpath.join(self.base, value))
+
+    def _location(self, value):
+        return ntpath.normcase(ntpath.normpath(ntpath.join(self.base, value)))
+
+    def _output_dirs(self):
+        """locations of the project directory and of every directory its build writes into"""
+        if self.outputs is None:
+            self.outputs = [self._location('.')]
+            for tag, entries in _output_dirs_re.findall(_utf8(_readBytes(self.path) or '') if self.path else ''):
+                for entry in entries.decode('utf-8').split(';'):
+                    if entry and '$(' not in entry and '%(' not in entry:
+                        self.outputs.append(self._location(entry if tag != 'Outputs' else ntpath.dirname(entry) or '.'))
+        return self.outputs
+
+    def _exists(self, entry):
+        """whether a directory entry is there or may be created by the build; only those outside the project's output tree are checked"""
+        value = entry.strip('"')
+        if '$(' in value or '%(' in value:
+            return True
+
+        location = self._location(value)
+        if any(location == d or location.startswith(d.rstrip('\\') + '\\') for d in self._output_dirs()):
+            return True
+        return os.path.isdir(os.path.join(self.base, value.replace('\\', os.sep)))
+
+    def optimize(self, entries, dirs):
+        seen = set()
+        kept = []
+        for entry in entries:
+            # only directories are looked up against the project; a bare library name is searched for, so it stays as written
+            entry, key = self._canonical(entry) if dirs else (entry, entry.lower())
+            if key in seen or (dirs and options.drop_missing_dirs and not self._exists(entry)):
+                continue
+            seen.add(key)
+            kept.append(entry)
+
+        self.removed += len(entries) - len(kept)
+        return kept
+
+    def handler(self, handler, dirs, sep = ';'):
+        # a _handle_list handler is named after its list expression
+        compiled = re.compile(handler.name)
+
+        def func(i, line):
+            ret = handler(i, line)
+            if ret is None:
+                return None
+
+            skip, lines = ret
+            lines = tuple(lines)
+            match = compiled.match(lines[0]) if len(lines) == 1 else None
+            if not match or not match.group('list'):
+                return (skip, lines)
+
+            old_list = match.group('list')
+            return (skip, (lines[0].replace(old_list, sep.join(self.optimize(old_list.split(sep), dirs)), 1),))
+
+        return _tagged(func, handler.tags, handler.name)
+
+    def wrap(self, make, dirs):
+        return _per_project(lambda filelines: self.handler(make(filelines), dirs))
+
+    def reported(self, path, lines):
+        for line in lines:
+            yield line
+
+        if self.removed:
+            _report(u'Removed %d redundant search path entries from %s' % (self.removed, path))
+
+_shared_sheet_names = ('qmake2.shared.props', 'qmake2.shared.targets')
+_shared_sheets_written = {}
+
+def _replacing(lines):
+    """lines as _handle_by_regex targets, at the indentation of the matched line"""
+    return tuple('\\1' + _make_path_replace_target(line) for line in lines)
+
+def _qt_properties():
+    return (
+        '<QT_VERSION_MAJOR>%s</QT_VERSION_MAJOR>' % globalInfo.major,
+        '<QT_VERSION_MINOR>%s</QT_VERSION_MINOR>' % globalInfo.minor,
+        '<QT_VERSION_PATCH>%s</QT_VERSION_PATCH>' % globalInfo.patch,
+        '<QTDIR>%s</QTDIR>' % globalInfo.path,
+    )
+
+def _toolset_definitions(manifest):
+    """what every project gets ahead of its own ItemDefinitionGroups"""
+    return (
+        '<PropertyGroup Condition="\'$(DesignTimeBuild)\'==\'true\'">',
+        '  <FixPreprocessorDefinitions>_MSC_VER=%d;_MSC_FULL_VER=%d;%s$(FixPreprocessorDefinitions)</FixPreprocessorDefinitions>' % (globalInfo.MSC_VER, globalInfo.MSC_FULL_VER, "__cplusplus=199711L;" if globalInfo.MSC_VER < 1900 else ""),
+        '</PropertyGroup>',
+        '<ItemDefinitionGroup>',
+        '  <ClCompile>',
+        '    <PreprocessorDefinitions Condition="\'$(FixPreprocessorDefinitions)\'!=\'\'">$(FixPreprocessorDefinitions)%(PreprocessorDefinitions)</PreprocessorDefinitions>',
+        '    <ProgramDataBaseFileName Condition="\'$(ConfigurationType)\'==\'StaticLibrary\'">$(OutDir)$(TargetName)$(TargetExt).pdb</ProgramDataBaseFileName>',
+        '  </ClCompile>',
+        '  <ResourceCompile>',
+        '    <PreprocessorDefinitions Condition="\'$(FixPreprocessorDefinitions)\'!=\'\'">$(FixPreprocessorDefinitions)%(PreprocessorDefinitions)</PreprocessorDefinitions>',
+        '  </ResourceCompile>',
+        '  <Manifest Condition="\'$(ConfigurationType)\'==\'Application\'">',
+        '    <AdditionalManifestFiles>%s</AdditionalManifestFiles>' % manifest,
+        '  </Manifest>',
+        '  <Link>',
+        '    <SubSystem>Windows</SubSystem>',
+        '  </Link>',
+        '</ItemDefinitionGroup>',
+    )
+
+def _shared_root(out):
+    """directory of the shared sheets a project imports: the innermost of options.shared_roots holding it, else its own"""
+    directory = os.path.dirname(os.path.abspath(out))
+    key = os.path.normcase(directory) + os.sep
+    roots = [root for root in options.shared_roots if key.startswith(os.path.normcase(root).rstrip(os.sep) + os.sep)]
+    return max(roots, key=len) if roots else directory
+
+def _shared_sheets(root):
+    """(name, lines) of the sheets the projects below root import"""
+    here = _relative(os.path.dirname(os.path.abspath(__file__)), root)
+    manifest = os.path.join(here, 'application.manifest') if os.path.isabs(here) else '$(MSBuildThisFileDirectory)' + os.path.join(here, 'application.manifest')
+    props = ('<PropertyGroup Label="Qt">',) + tuple('  ' + line for line in _qt_properties()) + ('</PropertyGroup>',)
+    targets = _toolset_definitions(manifest)
+    return zip(_shared_sheet_names, (
+        tuple('  ' + line for line in props),
+        tuple('  ' + line for line in targets) + _precompiled_header_source_rules + _unity_rules,
+    ))
+
+def _write_shared_props(root):
+    """writes the shared sheets into root, where their content changed since this process last did"""
+    for name, lines in _shared_sheets(root):
+        path = os.path.join(root, name)
+        content = _encodeLines((
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<Project ToolsVersion="4.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">',
+        ) + lines + (end_project,))
+        digest = hashlib.sha1(content).hexdigest()
+        if _shared_sheets_written.get(path) == digest:
+            continue
+
+        with _AtomicFile(path) as f:
+            f.write(content)
+        _shared_sheets_written[path] = digest
+        if f.replaced:
+            _report(u'Updated shared property sheet %s' % path)
+
+def _share_props(roots):
+    """makes the projects below roots import the shared sheets, written into each root up front"""
+    options.shared_roots = tuple(os.path.abspath(root) for root in roots)
+    for root in options.shared_roots:
+        _write_shared_props(root)
+
+def _vcxproj_factories(filelines, path, out, search_paths = None):
     enabledLibs, cur_qt_path_re = _is_qt_enabled(filelines, path)
 
     rel_to_this_path = os.path.dirname(__file__)
@@ -282,73 +1506,374 @@ def _cure_vcxproj(filelines, path, out):
     except:
         pass
 
+    sheets = None
+    if options.shared_props:
+        root = _shared_root(out)
+        _write_shared_props(root)
+        shared = _relative(root, os.path.dirname(os.path.abspath(out)))
+        sheets = tuple(os.path.normpath(os.path.join(shared, name)) for name in _shared_sheet_names)
+
+    factories = _vcxproj_handlers(cur_qt_path_re, rel_to_this_path, tuple(enabledLibs), sheets, _info_key())
+    factories = (('qrc_inputs', _per_project(_handle_qrc_inputs, os.path.dirname(out))),) + factories
+    if search_paths:
+        factories = tuple((name, search_paths.wrap(make, _search_path_lists[name]) if name in _search_path_lists else make) for name, make in factories)
+
+    pch = _auto_pch_plan(path, out) if options.auto_pch else None
+    if pch:
+        _write_auto_pch(out, *pch)
+        factories = (('auto_pch', _per_project(_handle_auto_pch, os.path.basename(_auto_pch_header(out)), pch[1])),) + factories
+
+    # ahead of every other rule, which would otherwise take the ExtensionTargets line first
+    plan = _unity_plan(path, out) if options.unity else None
+    return ((('unity', _per_project(_handle_unity, plan)),) if plan else ()) + factories
+
+def _cure_vcxproj(filelines, path, out):
+    if not isinstance(filelines, _LineWindow):
+        filelines = _IndexedLines(filelines)
+
+    search_paths = _SearchPaths(os.path.dirname(out), path)
+    factories = _vcxproj_factories(filelines, path, out, search_paths)
+    return search_paths.reported(path, _iter_handler_alllines(filelines, tuple(make(filelines) for name, make in factories)))
+_cure_vcxproj.streams = True
+_cure_vcxproj.stamps = _vcxproj_stamps
+
+@_lru_cache(64)
+def _vcxproj_handlers(cur_qt_path_re, rel_to_this_path, enabledLibs, sheets, info):
+    """named handler factories for the projects sharing these inputs, in the order the line engine tries them"""
+    qt_group = ('  <QtLib>%s</QtLib>' % (';'.join(enabledLibs)), '</PropertyGroup>')
+    if sheets:
+        # only what differs between the projects, the rest is imported from the shared sheets
+        qt_group = ('<Import Project="%s" />' % sheets[0], '<PropertyGroup Label="Qt">') + qt_group
+        definitions = ('<Import Project="%s" />' % sheets[1],)
+    else:
+        qt_group = ('<PropertyGroup Label="Qt">',) + tuple('  ' + line for line in _qt_properties()) + qt_group
+        definitions = _toolset_definitions(os.path.join(rel_to_this_path, "application.manifest"))
+
     base_handler = (
-        _handle_by_regex(r'^(\s*)<PropertyGroup Label="Globals">$', ('\\g<0>', '\\1  <PlatformToolset>%s</PlatformToolset>' % globalInfo.platformToolset)),
-        _handle_by_regex(r'^(\s*)<ConfigurationType>DynamicLibrary</ConfigurationType>$', ('\\g<0>', '\\1<GenerateManifest>false</GenerateManifest>')),
-        _handle_by_regex(r'^(\s*)<ConfigurationType>Application</ConfigurationType>$', ('\\g<0>', '\\1<GenerateManifest>true</GenerateManifest>')),
-        _handle_by_regex(r'^(\s*)<(ResourceOutputFileName)>\S+\/\$\(InputName\)(.res<\/\2>)$', ('\\1<\\2>$(OutDir)$(ProjectName)\\3',)),
-
-        _handle_by_regex(r'^(\s*)<PlatformToolset>.*</PlatformToolset>$', ()),
-        _handle_by_regex(r'^(\s*)<GenerateManifest>.*</GenerateManifest>$', ()),
-        _handle_once(_handle_by_regex(r'^(\s*)<ItemDefinitionGroup.*>$', (
-            '\\1<PropertyGroup Condition="\'$(DesignTimeBuild)\'==\'true\'">',
-            '\\1  <FixPreprocessorDefinitions>_MSC_VER=%d;_MSC_FULL_VER=%d;%s$(FixPreprocessorDefinitions)</FixPreprocessorDefinitions>' % (globalInfo.MSC_VER, globalInfo.MSC_FULL_VER, "__cplusplus=199711L;" if globalInfo.MSC_VER < 1900 else ""),
-            '\\1</PropertyGroup>',
-            '\\1<ItemDefinitionGroup>',
-            '\\1  <ClCompile>',
-            '\\1    <PreprocessorDefinitions Condition="\'$(FixPreprocessorDefinitions)\'!=\'\'">$(FixPreprocessorDefinitions)%(PreprocessorDefinitions)</PreprocessorDefinitions>',
-            '\\1    <ProgramDataBaseFileName Condition="\'$(ConfigurationType)\'==\'StaticLibrary\'">$(OutDir)$(TargetName)$(TargetExt).pdb</ProgramDataBaseFileName>',
-            '\\1  </ClCompile>',
-            '\\1  <ResourceCompile>',
-            '\\1    <PreprocessorDefinitions Condition="\'$(FixPreprocessorDefinitions)\'!=\'\'">$(FixPreprocessorDefinitions)%(PreprocessorDefinitions)</PreprocessorDefinitions>',
-            '\\1  </ResourceCompile>',
-            '\\1  <Manifest Condition="\'$(ConfigurationType)\'==\'Application\'">',
-            '\\1    <AdditionalManifestFiles>%s</AdditionalManifestFiles>' % _make_path_replace_target(os.path.join(rel_to_this_path, "application.manifest")),
-            '\\1  </Manifest>',
-            '\\1  <Link>',
-            '\\1    <SubSystem>Windows</SubSystem>',
-            '\\1  </Link>',
-            '\\1</ItemDefinitionGroup>',
-        ), False)),
-
-        _handle_custom_build(filelines),
-        _handle_by_regex(r'^(\s*)<(\S+)(.*)>(.*)\$\(NOINHERIT\)(.*)</\2>$', ('\\1<\\2\\3>\\4\\5</\\2>',)),
-        _handle_by_regex(r'^(\s*)<(\S+)(.*)>(.*)\$\(INHERIT\)(.*)</\2>$', ('\\1<\\2\\3>\\4%(\\2)\\5</\\2>',)),
-        _handle_list(r'^\s*<AdditionalIncludeDirectories>(?P<list>.*)</AdditionalIncludeDirectories>$', (
+        ('globals', _handle_by_regex(r'^(\s*)<PropertyGroup Label="Globals">$', ('\\g<0>', '\\1  <PlatformToolset>%s</PlatformToolset>' % globalInfo.platformToolset))),
+        ('dll_manifest', _handle_by_regex(r'^(\s*)<ConfigurationType>DynamicLibrary</ConfigurationType>$', ('\\g<0>', '\\1<GenerateManifest>false</GenerateManifest>'))),
+        ('app_manifest', _handle_by_regex(r'^(\s*)<ConfigurationType>Application</ConfigurationType>$', ('\\g<0>', '\\1<GenerateManifest>true</GenerateManifest>'))),
+        ('resource_output', _handle_by_regex(r'^(\s*)<(ResourceOutputFileName)>\S+\/\$\(InputName\)(.res<\/\2>)$', ('\\1<\\2>$(OutDir)$(ProjectName)\\3',))),
+
+        ('platform_toolset', _handle_by_regex(r'^(\s*)<PlatformToolset>.*</PlatformToolset>$', ())),
+        ('generate_manifest', _handle_by_regex(r'^(\s*)<GenerateManifest>.*</GenerateManifest>$', ())),
+        ('item_definition', _per_project_once(_handle_by_regex(r'^(\s*)<ItemDefinitionGroup.*>$', _replacing(definitions), False))),
+
+        ('custom_build', _per_project(_handle_custom_build)),
+        ('noinherit', _handle_by_regex(r'^(\s*)<(\S+)(.*)>(.*)\$\(NOINHERIT\)(.*)</\2>$', ('\\1<\\2\\3>\\4\\5</\\2>',))),
+        ('inherit', _handle_by_regex(r'^(\s*)<(\S+)(.*)>(.*)\$\(INHERIT\)(.*)</\2>$', ('\\1<\\2\\3>\\4%(\\2)\\5</\\2>',))),
+        ('include_dirs', _handle_list(_include_dirs_exp, (
             _handle_by_regex(r'^("?)%s.*\1$' % cur_qt_path_re, ()),
             _handle_by_regex(_make_path_re(globalInfo.temp_mkspec), (_make_path_replace_target(os.path.join(os.path.dirname(rel_to_this_path), "backport", "v90")),) if globalInfo.platformToolset == "v90" else ()),
-        )),
+        ))),
 
-        _handle_remove_range(filelines, r'^(?P<indent>\s+)<(?P<mark>CustomBuild) Include="(?P<file>.+\\.+\.(moc|res))">$'),
+        ('remove_moc_res', _per_project(_handle_remove_range, re.compile(r'^(?P<indent>\s+)<(?P<mark>CustomBuild) Include="(?P<file>.+\\.+\.(moc|res))">$'))),
     )
     qt_handler = (
-        _handle_by_regex(r'^(\s*)<Import Project="\$\(VCTargetsPath\)\\Microsoft\.Cpp\.props" />$', (
-            '\\1<PropertyGroup Label="Qt">',
-            '\\1  <QT_VERSION_MAJOR>%s</QT_VERSION_MAJOR>' % globalInfo.major,
-            '\\1  <QT_VERSION_MINOR>%s</QT_VERSION_MINOR>' % globalInfo.minor,
-            '\\1  <QT_VERSION_PATCH>%s</QT_VERSION_PATCH>' % globalInfo.patch,
-            '\\1  <QTDIR>%s</QTDIR>' % _make_path_replace_target(globalInfo.path),
-            '\\1  <QtLib>%s</QtLib>' % (';'.join(enabledLibs)),
-            '\\1</PropertyGroup>',
-        ), False),
-        _handle_by_regex(r'^(\s*)<ImportGroup Label="ExtensionSettings" />$', ('\\1<ImportGroup Label="ExtensionSettings">', '\\1  <Import Project="%s" />' % _make_path_replace_target(os.path.join(rel_to_this_path, "qt4.props")), '\\1</ImportGroup>')),
-        _handle_by_regex(r'^(\s*)<ImportGroup Label="ExtensionTargets" />$', ('\\1<ImportGroup Label="ExtensionTargets">', '\\1  <Import Project="%s" />' % _make_path_replace_target(os.path.join(rel_to_this_path, "qt4.targets")), '\\1</ImportGroup>')),
-        _handle_list(r'^\s*<PreprocessorDefinitions>(?P<list>.*)</PreprocessorDefinitions>$', (_handle_by_regex(r'QT_([A-Z]+_LIB|DLL|NO_DEBUG)', ()),)),
-        _handle_list(r'^\s*<AdditionalDependencies>(?P<list>.*)</AdditionalDependencies>$', (_handle_by_regex(r'%s[\\/]lib[\\/][Qq]t\w+\.lib' % cur_qt_path_re, ()),)),
-        _handle_list(r'^\s*<AdditionalLibraryDirectories>(?P<list>.*)</AdditionalLibraryDirectories>$', (_handle_by_regex(r'%s[\\/]lib' % cur_qt_path_re, ()),)),
-
-        _handle_remove_range(filelines, r'^(?P<indent>\s+)<(?P<mark>ClCompile) Include="(?P<file>.+\\(qrc|moc)_.+\.cpp)">$'),
-    ) if enabledLibs else ()
-
-    handlers = base_handler + qt_handler + (append_line, )
-
-    return _execute_handler_alllines(filelines, handlers)
+        ('qt_group', _handle_by_regex(r'^(\s*)<Import Project="\$\(VCTargetsPath\)\\Microsoft\.Cpp\.props" />$', _replacing(qt_group), False)),
+        ('extension_settings', _handle_by_regex(r'^(\s*)<ImportGroup Label="ExtensionSettings" />$', ('\\1<ImportGroup Label="ExtensionSettings">', '\\1  <Import Project="%s" />' % _make_path_replace_target(os.path.join(rel_to_this_path, "qt4.props")), '\\1</ImportGroup>'))),
+        ('extension_targets', _handle_by_regex(r'^(\s*)<ImportGroup Label="ExtensionTargets" />$', ('\\1<ImportGroup Label="ExtensionTargets">', '\\1  <Import Project="%s" />' % _make_path_replace_target(os.path.join(rel_to_this_path, "qt4.targets")), '\\1</ImportGroup>'))),
+        ('defines', _handle_list(r'^\s*<PreprocessorDefinitions>(?P<list>.*)</PreprocessorDefinitions>$', (_handle_by_regex(r'QT_([A-Z]+_LIB|DLL|NO_DEBUG)', ()),))),
+        ('dependencies', _handle_list(_dependencies_exp, (_handle_by_regex(r'%s[\\/]lib[\\/][Qq]t\w+\.lib' % cur_qt_path_re, ()),))),
+        ('library_dirs', _handle_list(_library_dirs_exp, (_handle_by_regex(r'%s[\\/]lib' % cur_qt_path_re, ()),))),
+
+        ('remove_generated_cpp', _per_project(_handle_remove_range, re.compile(r'^(?P<indent>\s+)<(?P<mark>ClCompile) Include="(?P<file>.+\\(qrc|moc)_.+\.cpp)">$'))),
+    ) if enabledLibs else (
+        # nothing to take out, but the lists are still optimized
+        ('dependencies', _handle_list(_dependencies_exp, ())),
+        ('library_dirs', _handle_list(_library_dirs_exp, ())),
+    )
+
+    handlers = base_handler + qt_handler + (('append', append_line), )
+
+    return tuple((name, h if getattr(h, 'per_project', False) else _shared(h)) for name, h in handlers)
+
+class _Element:
+    def __init__(self, tag, attrs, start, parent):
+        self.tag = tag
+        self.attrs = attrs
+        self.start = start
+        self.stop = start
+        self.parent = parent
+        self.children = []
+
+class _ParsedLines(_IndexedLines):
+    """file lines parsed once as XML: every element with its first and last line, indexed by tag"""
+
+    def __init__(self, filelines):
+        _IndexedLines.__init__(self, filelines)
+        self.elements = []
+        self.by_tag = {}
+        self._ranges = {}
+        stack = []
+        parser = xml.parsers.expat.ParserCreate('utf-8')
+
+        def start(tag, attrs):
+            element = _Element(tag, attrs, parser.CurrentLineNumber - 1, stack[-1] if stack else None)
+            if element.parent:
+                element.parent.children.append(element)
+            self.elements.append(element)
+            self.by_tag.setdefault(tag, []).append(element)
+            stack.append(element)
+
+        def end(tag):
+            element = stack.pop()
+            element.stop = parser.CurrentLineNumber - 1
+            if element.stop != element.start:
+                self._ranges.setdefault(element.start, element.stop)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.Parse(u'\n'.join(self).encode('utf-8'), True)
+        self.root = self.elements[0]
+
+    def of_tags(self, tags):
+        """elements carrying one of tags, or every element, in document order"""
+        if tags is None:
+            return self.elements
+        return sorted(itertools.chain.from_iterable(self.by_tag.get(tag, ()) for tag in tags), key=lambda e: e.start)
+
+    def starts(self, tags):
+        return sorted(set(e.start for e in self.of_tags(tags)))
+
+# untagged rules only run on the element lines holding their token
+_xml_rule_tokens = {
+    'noinherit': '$(NOINHERIT)',
+    'inherit': '$(INHERIT)',
+}
+
+def _xml_rule_results(filelines, name, handler):
+    if options.profile:
+        handler = _profiled(handler)
+
+    token = _xml_rule_tokens.get(name)
+    for i in filelines.starts(getattr(handler, 'tags', None)):
+        line = filelines[i]
+        if not token or token in line:
+            yield i, handler(i, line)
+
+def _xml_custom_build(filelines):
+    """the CustomBuild conversion over elements
+
+    A rule only looks at the line at its offset into the block, as the line engine does: qmake writes these blocks
+    in a fixed layout, and a block laid out otherwise is left alone by both engines.
+    """
+    marked = False
+    for element in filelines.of_tags(('CustomBuild', 'ClCompile')):
+        skip = element.stop - element.start + 1
+        if element.tag == 'CustomBuild':
+            match = _custom_build_range_re.match(filelines[element.start])
+            rule = next((r for r in _custom_build_rules if match and r[1].match(filelines[element.start + r[0]])), None)
+            if rule:
+                marked = marked or rule[3]
+                yield element.start, (skip, _expand(match, rule[2]))
+        elif marked and skip > 4 and _cl_compile_range_re.match(filelines[element.start]) and _precompiled_header_source_re.match(filelines[element.start + 3]):
+            yield element.start, (skip, ())
+
+    if marked and filelines[filelines.root.stop] == end_project:
+        yield filelines.root.stop, (0, _generated_targets(_precompiled_header_source_hook, _precompiled_header_source_rules))
+
+def _apply_edits(filelines, edits):
+    """filelines with every line's (order, (skip, lines)) results combined the way _execute_handler does"""
+    i = 0
+    for at in sorted(edits):
+        if at < i:
+            continue
+
+        for line in filelines[i:at]:
+            yield line
+
+        skip = 0
+        for order, (skip, lines) in sorted(edits[at], key=lambda edit: edit[0]):
+            for line in lines:
+                yield line
+            if skip != 0:
+                break
+
+        if skip == 0:
+            yield filelines[at]
+            skip = 1
+        i = at + skip
+
+    for line in filelines[i:]:
+        yield line
+
+def _cure_vcxproj_xml(filelines, path, out):
+    try:
+        filelines = _ParsedLines(filelines)
+    except xml.parsers.expat.ExpatError as e:
+        _report('Warning: %s is not well-formed XML (%s), curing it line by line' % (path, e), True)
+        return _cure_vcxproj(filelines, path, out)
+
+    search_paths = _SearchPaths(os.path.dirname(out), path)
+    edits = {}
+    for order, (name, make) in enumerate(_vcxproj_factories(filelines, path, out, search_paths)):
+        if name == 'append':
+            continue
+
+        results = _xml_custom_build(filelines) if name == 'custom_build' else _xml_rule_results(filelines, name, make(filelines))
+        for i, ret in results:
+            if ret is not None:
+                edits.setdefault(i, []).append((order, (ret[0], tuple(ret[1]))))
+
+    return search_paths.reported(path, _apply_edits(filelines, edits))
+_cure_vcxproj_xml.stamps = _vcxproj_stamps
+
+_item_re = re.compile(r'^\s*<(\w+) Include="([^"]*)"\s*/?>\r?$', re.M)
+_filters_item_re = re.compile(r'^(?P<indent>\s*)<(?P<mark>\w+) Include="(?P<file>[^"]*)"\s*(?P<empty>/?)>$')
+
+def _filters_project(out):
+    return out[:-len('.filters')]
+
+def _item_path(base, include):
+    return os.path.join(base, xml.sax.saxutils.unescape(include, {'&quot;': '"', '&apos;': "'"}).replace('\\', '/'))
+
+def _raw_items(raw):
+    return dict((include.decode('utf-8'), mark.decode('utf-8')) for mark, include in _item_re.findall(_utf8(raw)))
+
+def _project_items(project):
+    """Include -> item type of every item in a cured project, or None when it is missing"""
+    raw = _readBytes(project)
+    return _raw_items(raw) if raw is not None else None
+
+def _filters_in_sync(content, path, out):
+    items = _project_items(_filters_project(out))
+    if items is None:
+        return True
+
+    return all(mark == 'Filter' or items.get(include.decode('utf-8')) == mark for mark, include in _item_re.findall(content))
+
+def _handle_sync_filters(filelines, items):
+    def func(i, line):
+        match = _filters_item_re.match(line)
+        old = match.group('mark') if match else 'Filter'
+        if old == 'Filter':
+            return None
+
+        mark = items.get(match.group('file'))
+        if mark == old:
+            return None
+
+        stop = i
+        if not match.group('empty'):
+            stop = filelines.close_of(i)
+            if stop is None:
+                stop = filelines.index(match.expand('\\g<indent></\\g<mark>>'), i)
+
+        if mark is None:
+            return (stop - i + 1, ())
+
+        renamed = [line.replace('<' + old, '<' + mark, 1)]
+        if stop != i:
+            renamed += [filelines[k] for k in xrange(i + 1, stop)] + [filelines[stop].replace('</' + old + '>', '</' + mark + '>', 1)]
+        return (stop - i + 1, renamed)
+
+    return _tagged(func, None, '_handle_sync_filters')
 
 def _cure_vcxproj_filters(filelines, path, out):
-    return filelines
+    """renames and drops filter entries to match the item types of the cured project"""
+    items = _project_items(_filters_project(out))
+    if items is None:
+        return filelines
+
+    if not isinstance(filelines, _LineWindow):
+        filelines = _IndexedLines(filelines)
+    return _iter_handler_alllines(filelines, (_handle_sync_filters(filelines, items), append_line))
+_cure_vcxproj_filters.streams = True
+# filters which already agree with their project are only transcoded to UTF-8, never decoded into lines
+_cure_vcxproj_filters.passthrough = _filters_in_sync
+_cure_vcxproj_filters.depends = lambda out: (_filters_project(out),)
+
+class _SolutionGraph:
+    """projects of a solution and the dependency edges between them"""
+
+    def __init__(self):
+        self.projects = {}
+        self.deps = {}
+
+    def add_project(self, proj):
+        guid = proj['project_guid']
+        self.projects[guid] = proj
+        self.deps.setdefault(guid, collections.OrderedDict())
+
+    def add_dependency(self, guid, dep):
+        if guid in self.projects and dep in self.projects and dep != guid:
+            self.deps[guid][dep] = None
+
+    def _key(self, guid):
+        return (self.projects[guid]['project_name'].lower(), guid)
+
+    def order(self):
+        """dependencies first, ties broken by project name; returns (order, projects left in cycles)"""
+        pending = dict((guid, len(deps)) for guid, deps in self.deps.iteritems())
+        users = dict((guid, []) for guid in self.projects)
+        for guid, deps in self.deps.iteritems():
+            for dep in deps:
+                users[dep].append(guid)
+
+        ready = [self._key(guid) for guid, count in pending.iteritems() if count == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            guid = heapq.heappop(ready)[1]
+            order.append(guid)
+            for user in users[guid]:
+                pending[user] -= 1
+                if pending[user] == 0:
+                    heapq.heappush(ready, self._key(user))
+
+        return order, sorted((guid for guid, count in pending.iteritems() if count), key=self._key)
+
+    def find_cycle(self, remaining):
+        remaining = set(remaining)
+        seen = []
+        guid = min(remaining, key=self._key)
+        while guid not in seen:
+            seen.append(guid)
+            guid = next(dep for dep in self.deps[guid] if dep in remaining)
+
+        return seen[seen.index(guid):] + [guid]
+
+    def reduce(self, order):
+        """drops edges already implied by another dependency; order must be acyclic"""
+        reachable = {}
+        removed = 0
+        for guid in order:
+            deps = self.deps[guid]
+            implied = set()
+            for dep in deps:
+                implied |= reachable[dep]
+
+            kept = [dep for dep in deps if dep not in implied]
+            removed += len(deps) - len(kept)
+            self.deps[guid] = collections.OrderedDict.fromkeys(kept)
+            reachable[guid] = implied.union(deps)
+
+        return removed
+
+    def lines(self, path):
+        order, remaining = self.order()
+        if remaining:
+            cycle = self.find_cycle(remaining)
+            _report(u'Warning: dependency cycle in %s: %s' % (path, u' -> '.join(self.projects[guid]['project_name'] for guid in cycle)), True)
+        elif options.sln_reduce_deps:
+            removed = self.reduce(order)
+            if removed:
+                _report(u'Removed %d redundant dependencies from %s' % (removed, path))
+
+        position = dict((guid, n) for n, guid in enumerate(order + remaining))
+        for guid in order + remaining:
+            yield 'Project("{project_type}") = "{project_name}", "{project_path}", "{project_guid}"'.format(**self.projects[guid])
+            deps = sorted(self.deps[guid], key=position.get)
+            if deps:
+                yield '\tProjectSection(ProjectDependencies) = postProject'
+                for dep in deps:
+                    yield '\t\t{0} = {0}'.format(dep)
+                yield '\tEndProjectSection'
+            yield 'EndProject'
 
 def _cure_sln(filelines, path, out):
-    projs = {}
+    graph = _SolutionGraph()
 
     current_handler = [None]
 
@@ -381,10 +1906,7 @@ def _cure_sln(filelines, path, out):
         def func(i, line):
             match = regexp.match(line)
             if match:
-                proj = projs.get(match.group(2))
-                dep = projs.get(match.group(3))
-                if proj and dep:
-                    proj['project_dependencies'].append(dep)
+                graph.add_dependency(match.group(2), match.group(3))
 
             return eat_line(i, line)
 
@@ -401,12 +1923,15 @@ def _cure_sln(filelines, path, out):
         return (1, ('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution',))
 
     def global_end_handler(i, line):
+        # derived from where the solution is, so a cure of the same tree writes the same bytes
+        location = os.path.normcase(os.path.abspath(out))
+        guid = uuid.uuid5(uuid.NAMESPACE_URL, location.encode('utf-8') if isinstance(location, unicode) else location)
         return (1, (
             '\tGlobalSection(SolutionProperties) = preSolution',
             '\t\tHideSolutionNode = FALSE',
             '\tEndGlobalSection',
             '\tGlobalSection(ExtensibilityGlobals) = postSolution',
-            '\t\tSolutionGuid = {' + str(uuid.uuid4()).upper() + '}',
+            '\t\tSolutionGuid = {' + str(guid).upper() + '}',
             '\tEndGlobalSection',
             line,))
 
@@ -422,14 +1947,7 @@ def _cure_sln(filelines, path, out):
         return handlers.get(line, append_line)(i, line)
 
     def generate_projects():
-        def generate_project_depends(p):
-            deps = map(lambda x: '\t\t{project_guid} = {project_guid}'.format(**x), p['project_dependencies'])
-            return (['\tProjectSection(ProjectDependencies) = postProject'] + deps + ['\tEndProjectSection']) if deps else []
-
-        def genreate_project(p):
-            return ['Project("{project_type}") = "{project_name}", "{project_path}", "{project_guid}"'.format(**p)] + generate_project_depends(p) + ['EndProject']
-
-        return tuple(reduce(list.__add__, map(genreate_project, projs.values())))
+        return graph.lines(path)
 
 
     def generate_project_handler():
@@ -441,9 +1959,8 @@ def _cure_sln(filelines, path, out):
             if match:
                 projDict = match.groupdict()
                 projDict['project_path'] = projDict['project_path'].replace('/', '\\')
-                projDict['project_dependencies'] = []
                 if projDict['project_type'] == u'{8BC9CEB8-8B4A-11D0-8D11-00A0C91BC942}':
-                    projs[projDict['project_guid']] = projDict
+                    graph.add_project(projDict)
 
                 is_begin_project = begin_project[0]
                 begin_project[0] = True
@@ -469,13 +1986,19 @@ def _cure_sln(filelines, path, out):
     for i in xrange(0, len(filelines)):
         if skip == 0:
             skip, lines = current_handler[0](i, filelines[i])
-            ret += lines if not callable(lines) else (lines,)
+            if callable(lines):
+                ret.append(lines)
+            else:
+                ret.extend(lines)
 
         skip = skip - 1
 
     ret2 = []
-    for i in xrange(0, len(ret)):
-        ret2 += ret[i]() if callable(ret[i]) else (ret[i],)
+    for line in ret:
+        if callable(line):
+            ret2.extend(line())
+        else:
+            ret2.append(line)
 
     return ret2
 
@@ -487,42 +2010,304 @@ def _cure_qmake_conf(filelines, path, out):
         append_line,
     )
 
-    return _execute_handler_alllines(filelines, handlers)
-
-def _cure_path(path, doctor, out = None):
-    _saveFile(out or path, _loadFile(path, doctor, out or path))
+    return _iter_handler_alllines(filelines, handlers)
+_cure_qmake_conf.streams = True
+
+_script_version = []
+
+def _get_script_version():
+    if not _script_version:
+        with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb') as f:
+            _script_version.append(hashlib.sha1(f.read()).hexdigest())
+    return _script_version[0]
+
+def _cure_key(chunks, path, out, doctor):
+    h = hashlib.sha1()
+    # cures point imports and the backport mkspec at the script's own directory
+    inputs = (
+        _get_script_version(), os.path.dirname(os.path.abspath(__file__)), doctor.__name__, os.path.abspath(path), os.path.abspath(out),
+        globalInfo.platformToolset, globalInfo.MSC_VER, globalInfo.MSC_FULL_VER,
+        globalInfo.major, globalInfo.minor, globalInfo.patch, globalInfo.path,
+    ) + tuple(getattr(options, k) for k in _cure_options)
+    h.update(repr(inputs))
+    for depend in getattr(doctor, 'depends', lambda out: ())(out):
+        h.update(_readBytes(depend) or '')
+    scan, files = getattr(doctor, 'stamps', lambda path, out: (None, tuple))(path, out)
+    wide = False
+    # the temporary mkspec path changes on every run but never survives the cure
+    temp_mkspec_re = re.compile(_make_path_re(globalInfo.temp_mkspec)) if globalInfo.temp_mkspec else None
+    for i, chunk in enumerate(chunks):
+        h.update(temp_mkspec_re.sub('', chunk) if temp_mkspec_re else chunk)
+        if scan:
+            # UTF-16 lines can't be scanned one by one, and qmake never writes it anyway
+            wide = wide or (not i and _bom_encoding(chunk) == 'utf-16')
+            if not wide:
+                scan(chunk)
+    if wide:
+        for line in _utf8(_readBytes(path)).splitlines(True):
+            scan(line)
+    # files the doctor only looks into while it runs: their stamps are enough, and far cheaper to read
+    h.update(repr(sorted(_stamps(files()).iteritems())))
+    return h.hexdigest()
+
+def _cache_entry(key):
+    return os.path.join(options.cache_dir, key[:2], key)
+
+def _cache_open(entry):
+    try:
+        f = open(entry, 'rb')
+    except IOError:
+        return None, None
+
+    os.utime(entry, None)
+    return f, float(f.readline())
+
+def _cache_load(entry):
+    f, stamp = _cache_open(entry)
+    if f is None:
+        return None, None
+
+    with f:
+        return f.read(), stamp
+
+def _cache_store(entry, content, stamp):
+    if not os.path.isdir(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            pass
+
+    temp = '%s.%d' % (entry, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write('%r\n' % stamp)
+        if isinstance(content, str):
+            f.write(content)
+        else:
+            shutil.copyfileobj(content, f)
+    try:
+        os.rename(temp, entry)
+    except OSError:
+        os.remove(temp)
+
+def _restamp(out, digest):
+    """gives a rewritten out the timestamp of the last cure of that same path if it wrote the bytes of this SHA-1, so nothing looks dirty"""
+    entry = _json_entry('outputs', out)
+    if entry is None:
+        return
+
+    last = _load_json(entry)
+    if last and last[0] == digest:
+        os.utime(out, (time.time(), last[1]))
+    else:
+        _store_json(entry, (digest, os.path.getmtime(out)))
+
+def _evict_cache():
+    entries = []
+    for root, dirs, files in os.walk(options.cache_dir):
+        for name in files:
+            entry = os.path.join(root, name)
+            try:
+                st = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+
+    size = 0
+    for mtime, entry_size, entry in sorted(entries, reverse=True):
+        size += entry_size
+        if size > options.cache_size:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+def _cure_path_streaming(path, doctor, out, entry):
+    """(encoding, 'hit' or 'miss'), the latter None when the cure cache isn't used"""
+    if entry:
+        cached, stamp = _cache_open(entry)
+        if cached is not None:
+            with cached:
+                with _AtomicFile(out) as f:
+                    shutil.copyfileobj(cached, f)
+            if f.replaced:
+                _restamp(out, f.digest.hexdigest())
+            return None, 'hit'
+
+    with open(path, 'rb') as source:
+        encoding = _sniff_encoding(source)
+        with _AtomicFile(out) as f:
+            sep = ''
+            for line in doctor(_LineWindow(_iterLines(source, encoding)), path, out):
+                f.write(sep + line.encode('utf-8'))
+                sep = '\r\n'
+
+    if entry:
+        if f.replaced:
+            _restamp(out, f.digest.hexdigest())
+        with open(out, 'rb') as content:
+            _cache_store(entry, content, os.path.getmtime(out))
+
+    return encoding, 'miss' if entry else None
+
+def _cure_path(path, doctor, out = None, cache = False):
+    """cures path into out; returns the cure cache key when the cache was used"""
+    out = out or path
+    timer = _FileTimer(path, doctor) if options.profile else _null_timer
+
+    if options.stream and getattr(doctor, 'streams', False):
+        key = None
+        if cache:
+            with open(path, 'rb') as f:
+                key = _cure_key(f, path, out, doctor)
+        encoding, hit = _cure_path_streaming(path, doctor, out, key and _cache_entry(key))
+        timer('cure')
+        timer.done(stream=True, encoding=encoding, **({'cache': hit} if hit else {}))
+        return key
+
+    raw = _readBytes(path)
+    passthrough = getattr(doctor, 'passthrough', None)
+    if passthrough:
+        content = _utf8(raw)
+        if passthrough(content, path, out):
+            timer('load')
+            if (raw if out == path else _readBytes(out)) != content:
+                _writeBytes(out, content, False)
+            timer('save')
+            timer.done(passthrough=True)
+            return
+
+    if not cache:
+        filelines, encoding = _decode(raw)
+        timer('load')
+        content = list(doctor(filelines, path, out))
+        timer('cure')
+        _saveFile(out, content)
+        timer('save')
+        timer.done(encoding=encoding)
+        return
+
+    key = _cure_key(raw.splitlines(True), path, out, doctor)
+    entry = _cache_entry(key)
+    content, stamp = _cache_load(entry)
+    encoding = None
+    timer('load')
+    if content is None:
+        filelines, encoding = _decode(raw)
+        content = _encodeLines(doctor(filelines, path, out))
+        timer('cure')
+
+    if (raw if out == path else _readBytes(out)) != content:
+        _writeBytes(out, content, False)
+        _restamp(out, hashlib.sha1(content).hexdigest())
+
+    if stamp is None:
+        _cache_store(entry, content, os.path.getmtime(out))
+    timer('save')
+    timer.done(cache='hit' if stamp is not None else 'miss', encoding=encoding)
+    return key
+
+# what the cure job running on this thread has to say, handed back with its result so it lands in the job's tree output
+_job = threading.local()
+
+def _report(message, err = False):
+    messages = getattr(_job, 'messages', None)
+    if messages is None:
+        print >> (sys.stderr if err else sys.stdout), message
+    else:
+        messages.append((err, message))
 
 def _cure_projects(path):
     doctors = (
-        ('.vcxproj', _cure_vcxproj),
+        ('.vcxproj', _cure_vcxproj_xml if options.engine == 'xml' else _cure_vcxproj),
         ('.vcxproj.filters', _cure_vcxproj_filters),
         ('.sln', _cure_sln),
     )
 
+    key = None
     for extension, doctor in doctors:
         if path.endswith(extension):
-            _cure_path(path, doctor)
+            key = _cure_path(path, doctor, cache = options.cache)
             break
 
-def _devnull():
-    return open(os.devnull, 'w')
+    # the filters follow the item types their project was just cured to
+    if path.endswith('.vcxproj') and os.path.exists(path + '.filters'):
+        _cure_path(path + '.filters', _cure_vcxproj_filters, cache = options.cache)
 
-def _prepare_env():
-    process = subprocess.Popen(['qmake', '-v'],
-            stdout=subprocess.PIPE,
-            stderr=_devnull())
+    if path.endswith('.vcxproj') and options.moc_index:
+        _index_moc(path, key)
 
-    qt_ver_msg = process.communicate()[0].splitlines(False)
-    match = re.compile(r'^Using Qt version (?P<major>\d+).(?P<minor>\d+).(?P<patch>\d+) in (?P<path>.*?)([/\\]lib)?$').match(qt_ver_msg[1])
-    if match:
-        print match.group(0)
-        for k, v in match.groupdict().iteritems():
-            setattr(globalInfo, k, v)
+def _cure_projects_job(path):
+    _job.messages = []
+    try:
+        _cure_projects(path)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
 
-        globalInfo.path_re = _make_path_re(globalInfo.path)
+    messages, _job.messages = _job.messages, None
+    return (path, error, _profiler.take() if options.profile else None, messages)
+
+def _init_worker(info, opts):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for k, v in info.iteritems():
+        setattr(globalInfo, k, v)
+    for k, v in opts.iteritems():
+        setattr(options, k, v)
+
+def _cure_pool():
+    return multiprocessing.Pool(options.jobs, _init_worker, (vars(globalInfo), vars(options))) if options.jobs > 1 else None
+
+def _cure_all(projects, pool = None, out = None, err = None):
+    out = out or sys.stdout
+    err = err or sys.stderr
+    own_pool = not pool
+    if own_pool:
+        pool = _cure_pool()
+
+    if not pool:
+        results = map(_cure_projects_job, projects)
     else:
-        raise Exception('Can\'t detect Qt version, reutrn is %s.' % qt_ver_msg)
+        # solutions are cured last, once every project they reference is done
+        pending = []
+        solutions = []
+        for proj in projects:
+            if proj.endswith('.sln'):
+                solutions.append(proj)
+            else:
+                pending.append(pool.apply_async(_cure_projects_job, (proj,)))
+
+        results = [r.get() for r in pending] + pool.map(_cure_projects_job, solutions)
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    for path, error, profile, messages in results:
+        if profile:
+            _profiler.merge(profile)
+        for is_err, message in messages:
+            print >> (err if is_err else out), message
+
+    failures = [(path, error) for path, error, profile, messages in results if error]
+    for path, error in failures:
+        print >> err, 'Failed to cure %s:' % path
+        print >> err, error
+
+    return failures
+
+def _devnull():
+    return open(os.devnull, 'w')
+
+def _which(name):
+    exts = os.environ.get('PATHEXT', '.EXE').split(os.pathsep) if os.name == 'nt' else ('',)
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        for ext in exts:
+            candidate = os.path.join(d, name + ext)
+            if os.path.isfile(candidate):
+                return os.path.abspath(candidate)
 
+    return None
+
+def _select_msvc():
     platform, msvc = os.environ["QMAKESPEC"].split('-')
     if msvc.startswith('msvc'):
         msvc = msvc[4:]
@@ -536,43 +2321,750 @@ def _prepare_env():
     for k, v in globalInfo.msvc_vers[msvc].iteritems():
         setattr(globalInfo, k, v)
 
-    globalInfo.temp_mkspec = tempfile.mkdtemp()
+def _detect_qt(qt_ver_output):
+    qt_ver_msg = qt_ver_output.splitlines(False)
+    match = re.compile(r'^Using Qt version (?P<major>\d+).(?P<minor>\d+).(?P<patch>\d+) in (?P<path>.*?)([/\\]lib)?$').match(qt_ver_msg[1]) if len(qt_ver_msg) > 1 else None
+    if match:
+        print match.group(0)
+        for k, v in match.groupdict().iteritems():
+            setattr(globalInfo, k, v)
 
-    _cure_path(os.path.join(globalInfo.path, "mkspecs", "win32-msvc2010", "qmake.conf"), _cure_qmake_conf, os.path.join(globalInfo.temp_mkspec, "qmake.conf"))
-    shutil.copyfile(os.path.join(globalInfo.path, "mkspecs", "win32-msvc2005", "qplatformdefs.h"), os.path.join(globalInfo.temp_mkspec, "qplatformdefs.h"))
+        globalInfo.path_re = _make_path_re(globalInfo.path)
+    else:
+        raise Exception('Can\'t detect Qt version, reutrn is %s.' % qt_ver_msg)
+
+def _mkspec_sources():
+    return (
+        os.path.join(globalInfo.path, "mkspecs", "win32-msvc2010", "qmake.conf"),
+        os.path.join(globalInfo.path, "mkspecs", "win32-msvc2005", "qplatformdefs.h"),
+    )
+
+def _make_mkspec(mkspec):
+    conf, defs = _mkspec_sources()
+    _cure_path(conf, _cure_qmake_conf, os.path.join(mkspec, "qmake.conf"))
+    shutil.copyfile(defs, os.path.join(mkspec, "qplatformdefs.h"))
+
+def _env_key(qmake):
+    stat = os.stat(qmake)
+    inputs = (_get_script_version(), os.path.normcase(qmake), stat.st_mtime, stat.st_size, os.environ["QMAKESPEC"], globalInfo.platformToolset)
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+def _mkspec_generation(entry):
+    """the cured mkspec of entry for the current mkspec sources; entries are only ever added, as other runs may be using them"""
+    mtimes = [os.path.getmtime(source) for source in _mkspec_sources()]
+    return os.path.join(entry, hashlib.sha1(repr(mtimes)).hexdigest())
+
+def _touch_env(entry, mkspec):
+    """marks an entry and its mkspec generation as in use, which keeps _prune_env from them"""
+    os.utime(os.path.join(entry, 'env'), None)
+    os.utime(mkspec, None)
+
+def _discard(path):
+    # renamed first, so nobody finds it half removed
+    gone = '%s.%d.old' % (path, os.getpid())
+    try:
+        os.rename(path, gone)
+    except OSError:
+        return
+    shutil.rmtree(gone, True)
+
+def _prune_env():
+    """removes the mkspec generations, then the entries, no run has used for options.env_cache_days
+
+    Runs touch what they use whenever they run qmake with it, so anything older has no live user.
+    """
+    limit = time.time() - options.env_cache_days * 86400
+    try:
+        names = os.listdir(options.env_cache_dir)
+    except OSError:
+        return
+
+    for name in names:
+        entry = os.path.join(options.env_cache_dir, name)
+        try:
+            paths = [os.path.join(entry, n) for n in os.listdir(entry)]
+        except OSError:
+            continue
+
+        live = False
+        for path in paths:
+            try:
+                if os.path.getmtime(path) >= limit:
+                    live = True
+                elif os.path.isdir(path):
+                    _discard(path)
+            except OSError:
+                pass
+        if not live:
+            _discard(entry)
+
+def _load_env(entry):
+    """uses a cached qmake -v answer and cured mkspec if its sources are unchanged"""
+    try:
+        with open(os.path.join(entry, 'env'), 'rb') as f:
+            qt_ver_output = f.read()
+    except IOError:
+        return False
+
+    _detect_qt(qt_ver_output)
+    try:
+        mkspec = _mkspec_generation(entry)
+        _touch_env(entry, mkspec)
+    except OSError:
+        return False
+
+    globalInfo.temp_mkspec = mkspec
+    globalInfo.keep_mkspec = True
+    return True
+
+def _store_env(entry, qt_ver_output):
+    try:
+        os.makedirs(entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+
+    if not os.path.exists(os.path.join(entry, 'env')):
+        with _AtomicFile(os.path.join(entry, 'env')) as f:
+            f.write(qt_ver_output)
+
+    mkspec = _mkspec_generation(entry)
+    temp = tempfile.mkdtemp(dir=entry)
+    _make_mkspec(temp)
+    try:
+        os.rename(temp, mkspec)
+    except OSError:
+        # another run stored the same generation first, and may be using it
+        shutil.rmtree(temp, True)
+        if not os.path.isdir(mkspec):
+            return False
+    _touch_env(entry, mkspec)
+
+    globalInfo.temp_mkspec = mkspec
+    globalInfo.keep_mkspec = True
+    return True
+
+def _prepare_env():
+    _select_msvc()
+    globalInfo.keep_mkspec = False
+
+    qmake = _which('qmake') if options.env_cache else None
+    if qmake:
+        _prune_env()
+        entry = os.path.join(options.env_cache_dir, _env_key(qmake))
+        if _load_env(entry):
+            return
+
+    process = subprocess.Popen(['qmake', '-v'],
+            stdout=subprocess.PIPE,
+            stderr=_devnull())
+
+    qt_ver_output = process.communicate()[0]
+    _detect_qt(qt_ver_output)
+
+    if not (qmake and _store_env(entry, qt_ver_output)):
+        globalInfo.temp_mkspec = tempfile.mkdtemp()
+        _make_mkspec(globalInfo.temp_mkspec)
 
     return
 
 def _clear_env():
-    if globalInfo.temp_mkspec:
+    if globalInfo.temp_mkspec and not globalInfo.keep_mkspec:
         shutil.rmtree(globalInfo.temp_mkspec)
 
 def _signal_handler(sig, frame):
     _clear_env()
     sys.exit(0)
 
+def _parse_args(args):
+    i = 0
+    while i < len(args) and args[i].startswith("--"):
+        name, sep, value = args[i][2:].partition('=')
+        toolset = next((k for k in globalInfo.msvc_vers if globalInfo.msvc_vers[k]['platformToolset'] == name), None)
+        if toolset:
+            platform = os.environ["QMAKESPEC"].split('-')[0] if "QMAKESPEC" in os.environ else 'win32'
+            os.environ["QMAKESPEC"] = "%s-%s" % (platform, toolset)
+        elif name in _arg_options:
+            attr, convert = _arg_options[name][:2]
+            if callable(convert) and not sep and len(_arg_options[name]) > 2:
+                value = _arg_options[name][2]
+            elif callable(convert):
+                if not sep:
+                    i += 1
+                    if i == len(args):
+                        raise Exception('--%s requires a value' % name)
+                    value = args[i]
+                value = convert(value)
+            else:
+                value = convert
+            setattr(options, attr, value)
+        else:
+            break
+        i += 1
+
+    return args[i:]
+
+_output_lock = threading.Lock()
+
+class _PrefixedOutput:
+    """line-buffered writer that tags every line with the tree it came from"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+        self.partial = ''
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        with _output_lock:
+            for line in lines:
+                self.stream.write(self.prefix + line.rstrip('\r') + '\n')
+            self.stream.flush()
+
+    def flush(self):
+        pass
+
+def _pump(stream, out):
+    for line in iter(stream.readline, ''):
+        out.write(line)
+
+def _qmake_log_path(cwd):
+    if not cwd:
+        return options.qmake_log
+
+    # one log per tree or project qmake runs in
+    root, ext = os.path.splitext(options.qmake_log)
+    return '%s-%s%s' % (root, re.sub(r'[\\/:]+', '_', _relative(cwd, os.getcwd()).strip('.\\/')) or 'root', ext)
+
+def _run_tree(qmake_args, cwd = None, pool = None, out = None, err = None, recursive = True, sources = None):
+    """runs qmake and cures what it writes; sources gets the absolute .pro path of every project"""
+    print >> (out or sys.stdout), u'Running qmake @ ' + (cwd or os.getcwdu())
+    if globalInfo.keep_mkspec:
+        try:
+            _touch_env(os.path.dirname(globalInfo.temp_mkspec), globalInfo.temp_mkspec)
+        except OSError:
+            pass
+    qmake_start = time.time()
+    process = subprocess.Popen(['qmake', '-d', '-tp', 'vc'] + (['-r'] if recursive else []) + ['-spec', globalInfo.temp_mkspec] + qmake_args,
+                               cwd=cwd,
+                               stdout=subprocess.PIPE if out else None,
+                               stderr=subprocess.PIPE)
+    if out:
+        pump = threading.Thread(target=_pump, args=(process.stdout, out))
+        pump.daemon = True
+        pump.start()
+
+    found = {} if sources is not None else None
+    log = _CompressedLog(_qmake_log_path(cwd)) if options.qmake_log else None
+    def projects():
+        for proj in _getProjects(process.stderr, found, log, cwd):
+            yield os.path.join(cwd, proj) if cwd else proj
+
+        process.wait()
+        if log:
+            log.close()
+        _profiler.span('qmake', qmake_start, time.time(), **({'tree': cwd} if cwd else {}))
+
+    failures = _cure_all(projects(), pool, out, err)
+    if out:
+        pump.join()
+
+    if sources is not None:
+        for proj, pro in found.iteritems():
+            path = os.path.normcase(os.path.abspath(os.path.join(cwd or '', proj)))
+            sources[path] = _find_pro(path, pro and os.path.abspath(os.path.join(cwd or '', pro)))
+
+    return failures, process.returncode
+
+def _find_pro(proj, pro):
+    """the .pro qmake reported for proj, else the only .pro beside it"""
+    if pro and os.path.isfile(pro):
+        return os.path.normcase(pro)
+
+    directory = os.path.dirname(proj)
+    candidates = [name for name in os.listdir(directory) if name.endswith('.pro')] if os.path.isdir(directory) else []
+    return os.path.normcase(os.path.join(directory, candidates[0])) if len(candidates) == 1 else None
+
+_include_re = re.compile(r'\binclude\s*\(\s*"?(?P<file>[^",)]+?)"?\s*[,)]')
+
+_qmake_conf_names = ('.qmake.conf', '.qmake.cache')
+_env_var_re = re.compile(r'\$\$\(\s*(\w+)\s*\)|\$\$getenv\s*\(\s*(\w+)\s*\)')
+_files_re = re.compile(r'\$\$files\s*\(\s*"?(?P<pattern>[^",)]+?)"?\s*(?:,\s*(?P<recursive>\w+)\s*)?\)')
+_assignment_re = re.compile(r'^\s*[\w.]+\s*[-+*~]?=(.*)$')
+
+def _pro_variables(path, pro):
+    return {'PWD': os.path.dirname(path), 'IN_PWD': os.path.dirname(path), '_PRO_FILE_PWD_': os.path.dirname(pro)}
+
+def _expand_pro(text, variables):
+    """text with the variables qmake would know without evaluating anything substituted"""
+    text = _env_var_re.sub(lambda m: os.environ.get(m.group(1) or m.group(2), m.group(0)), text)
+    return re.sub(r'\$\$\{?(\w+)\}?', lambda m: variables.get(m.group(1), m.group(0)), text)
+
+def _pro_inputs(pro):
+    """pro, every .pri it includes as far as the include paths can be resolved without qmake, and the .qmake.conf/.qmake.cache it may pick up"""
+    inputs = set()
+    pending = [pro]
+    directory = os.path.dirname(pro)
+    while True:
+        pending += [os.path.join(directory, name) for name in _qmake_conf_names]
+        if os.path.dirname(directory) == directory:
+            break
+        directory = os.path.dirname(directory)
+
+    while pending:
+        path = pending.pop()
+        if path in inputs:
+            continue
+        inputs.add(path)
+
+        content = _readBytes(path)
+        if content is None:
+            continue
+
+        variables = _pro_variables(path, pro)
+        for line in content.splitlines():
+            for match in _include_re.finditer(line.split('#', 1)[0]):
+                include = _expand_pro(match.group('file'), variables)
+                if '$$' not in include:
+                    pending.append(os.path.normcase(os.path.normpath(os.path.join(os.path.dirname(path), include))))
+
+    return frozenset(inputs)
+
+def _listing(pattern, recursive):
+    if not recursive:
+        return sorted(glob.glob(pattern))
+
+    directory, name = os.path.split(pattern)
+    return sorted(os.path.join(root, match) for root, dirs, files in os.walk(directory or os.curdir) for match in fnmatch.filter(dirs + files, name))
+
+def _pro_volatile(pro, inputs):
+    """digest of what the inputs of pro read besides themselves: environment variables and wildcard listings
+
+    None when a wildcard can't be resolved without qmake, so the project is never taken as up to date.
+    """
+    read = []
+    for path in sorted(inputs):
+        content = _readBytes(path)
+        if content is None:
+            continue
+
+        variables = _pro_variables(path, pro)
+        for line in content.splitlines():
+            line = line.split('#', 1)[0]
+            read += [(name, os.environ.get(name)) for name in (m.group(1) or m.group(2) for m in _env_var_re.finditer(line))]
+
+            patterns = [(m.group('pattern'), (m.group('recursive') or '').lower() == 'true') for m in _files_re.finditer(line)]
+            assignment = _assignment_re.match(line)
+            if assignment:
+                # qmake expands wildcards in the file lists themselves too
+                patterns += [(token, False) for token in assignment.group(1).split() if ('*' in token or '?' in token) and '$$files' not in token]
+
+            for pattern, recursive in patterns:
+                pattern = _expand_pro(pattern.strip('"'), variables)
+                if '$$' in pattern or '$(' in pattern:
+                    return None
+                pattern = os.path.join(os.path.dirname(pro), pattern.replace('\\', os.sep))
+                read.append((pattern, recursive, _listing(pattern, recursive)))
+
+    # json, as the paths are unicode when they come from a manifest
+    return hashlib.sha1(json.dumps(read)).hexdigest()
+
+def _stamps(paths):
+    stamps = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps[path] = (st.st_mtime, st.st_size)
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+def _pro_args(qmake_args):
+    # the tree's own .pro is replaced by the project being regenerated
+    return [arg for arg in qmake_args if not (arg.endswith('.pro') and os.path.isfile(arg))]
+
+def _watch(qmake_args):
+    """regenerates the projects whose .pro/.pri inputs change, polling until interrupted
+
+    A changed subdirs project reruns the whole tree; projects whose .pro can't be found aren't watched.
+    """
+    pool = _cure_pool()
+    sources = {}
+    _run_tree(qmake_args, pool = pool, sources = sources)
+    inputs = dict((proj, _pro_inputs(pro) if pro else frozenset()) for proj, pro in sources.iteritems())
+    stamps = _stamps(set().union(*inputs.values()))
+    print 'Watching %d files of %d projects' % (len(stamps), len(inputs))
+
+    while True:
+        time.sleep(options.watch_interval)
+        current = _stamps(stamps)
+        changed = set(path for path in current if current[path] != stamps[path])
+        if not changed:
+            continue
+
+        start = time.time()
+        dirty = sorted(proj for proj in inputs if inputs[proj] & changed)
+        if any(proj.endswith('.sln') for proj in dirty):
+            sources = {}
+            failures = _run_tree(qmake_args, pool = pool, sources = sources)[0]
+            dirty = sources
+        else:
+            failures = []
+            for proj in dirty:
+                failures += _run_tree(_pro_args(qmake_args) + [sources[proj]], os.path.dirname(proj), pool, recursive = False, sources = sources)[0]
+
+        inputs = dict((proj, _pro_inputs(pro) if pro else frozenset()) for proj, pro in sources.iteritems())
+        stamps = _stamps(set().union(*inputs.values()))
+        print 'Regenerated %d projects in %.2fs%s' % (len(dirty), time.time() - start, ', %d failed' % len(failures) if failures else '')
+
+def _json_entry(kind, path):
+    return os.path.join(options.cache_dir, kind, hashlib.sha1(os.path.abspath(path)).hexdigest()) if options.cache else None
+
+def _load_json(entry):
+    try:
+        with open(entry, 'rb') as f:
+            return json.load(f)
+    except (IOError, TypeError, ValueError):
+        return None
+
+def _store_json(entry, data):
+    if not os.path.isdir(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            pass
+    with _AtomicFile(entry) as f:
+        f.write(json.dumps(data))
+
+# what qt4.targets' _QtMocCheckHeader and _QtMocCheckSource look for
+_moc_header_re = re.compile(r'\bQ_OBJECT(?!_FAKE)\b|Q_GADGET')
+_moc_included_header_re = re.compile(r'^\s*#include\s*["<]moc_(.+)\.cpp[">]\s*$', re.M)
+
+def _moc_scan(path, header):
+    """(needs moc, moc_*.cpp headers it includes) of a header or source, or None when it can't be read"""
+    raw = _readBytes(path)
+    if raw is None:
+        return None
+    if _bom_encoding(raw):
+        raw = _utf8(raw)
+
+    if header:
+        return bool(_moc_header_re.search(raw)), ''
+
+    own_moc = re.compile(r'^\s*#include\s*["<]%s\.moc[">]\s*$' % re.escape(os.path.splitext(os.path.basename(path))[0]), re.M)
+    return bool(own_moc.search(raw)), ';'.join(name + '.h' for name in _moc_included_header_re.findall(raw))
+
+_scan_threads = []
+
+def _scan_pool():
+    # reading the files is most of a scan, so threads overlap it well enough
+    if not _scan_threads:
+        _scan_threads.append(multiprocessing.pool.ThreadPool(max(2, options.jobs)))
+    return _scan_threads[0]
+
+def _moc_index_path(project):
+    return os.path.splitext(project)[0] + '.qtmoc.props'
+
+def _index_moc(project, key = None):
+    """writes the sidecar props telling qt4.targets which of the project's files need moc
+
+    Files are only scanned again once their mtime or size changed since the last index. key is the cure cache key
+    the project was written with: when it is the one of the last index, its items are known without reading it.
+    """
+    entry = _json_entry('moc', project)
+    last = _load_json(entry) or {}
+    if key and last.get('key') == key:
+        listed = last['files']
+    else:
+        raw = _readBytes(project)
+        if raw is None:
+            return
+        listed = sorted([include, mark == 'ClInclude'] for include, mark in _raw_items(raw).iteritems()
+                        if mark in ('ClInclude', 'ClCompile') and '$(' not in include and '@(' not in include) if 'qt4.targets' in raw else None
+    if listed is None:
+        if entry:
+            _store_json(entry, {'key': key, 'files': None})
+        return
+
+    base = os.path.dirname(project)
+    files = dict((include, (_item_path(base, include), header)) for include, header in listed)
+    stamps = _stamps(path for path, header in files.itervalues())
+    index = last.get('index') or {}
+
+    stale = [include for include, (path, header) in files.iteritems()
+             if stamps[path] and (include not in index or index[include][0] != list(stamps[path]))]
+    for include, result in zip(stale, _scan_pool().map(lambda include: _moc_scan(*files[include]), stale)):
+        if result:
+            index[include] = [list(stamps[files[include][0]])] + list(result)
+
+    lines = [
+        u'<?xml version="1.0" encoding="utf-8"?>',
+        u'<Project ToolsVersion="4.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">',
+        u'  <ItemGroup>',
+    ]
+    for include in sorted(files):
+        if include not in index or not stamps[files[include][0]]:
+            continue
+
+        stamp, enable, included = index[include]
+        mark = 'QtMocHeaderIndex' if files[include][1] else 'QtMocSourceIndex'
+        lines += [u'    <%s Include="%s">' % (mark, include), u'      <Enable>%s</Enable>' % ('true' if enable else 'false')]
+        if included:
+            lines.append(u'      <IncludedHeader>%s</IncludedHeader>' % xml.sax.saxutils.escape(included))
+        lines.append(u'    </%s>' % mark)
+    lines += [u'  </ItemGroup>', u'</Project>']
+
+    sidecar = _moc_index_path(project)
+    _saveFile(sidecar, lines)
+    if stale:
+        # qt4.targets rescans whatever is newer than the index
+        os.utime(sidecar, None)
+
+    if entry:
+        _store_json(entry, {'key': key, 'files': listed, 'index': dict((include, index[include]) for include in files if include in index)})
+
+_manifest_name = '.qmake2.manifest.json'
+
+def _qmake_features():
+    """the mkspec sources and every .prf feature qmake may read, wherever Qt and the environment put them"""
+    roots = [os.path.join(globalInfo.path, 'mkspecs', 'features')]
+    roots += [d for d in os.environ.get('QMAKEFEATURES', '').split(os.pathsep) if d]
+    roots += [os.path.join(d, 'mkspecs', 'features') for d in os.environ.get('QMAKEPATH', '').split(os.pathsep) if d]
+
+    paths = list(_mkspec_sources())
+    for root in roots:
+        for directory, dirs, files in os.walk(root):
+            paths += [os.path.join(directory, name) for name in files if name.endswith('.prf')]
+    return paths
+
+def _manifest_env(qmake_args):
+    # everything besides the .pro/.pri files that shapes what qmake writes or how it is cured
+    info = sorted((k, v) for k, v in vars(globalInfo).iteritems() if k not in ('temp_mkspec', 'keep_mkspec'))
+    qmake = _which('qmake')
+    inputs = (
+        _get_script_version(), os.path.normcase(os.getcwd()), os.environ.get('QMAKESPEC'), qmake_args, info,
+        [(name, os.environ.get(name)) for name in ('QMAKEPATH', 'QMAKEFEATURES')],
+        sorted(_stamps(([qmake] if qmake else []) + _qmake_features()).iteritems()),
+    ) + tuple(getattr(options, k) for k in _output_options)
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+def _hash_file(path):
+    content = _readBytes(path)
+    return hashlib.sha1(content).hexdigest() if content is not None else None
+
+def _relative(path, base):
+    try:
+        return os.path.relpath(path, base)
+    except ValueError:
+        # another drive
+        return path
+
+def _save_manifest(manifest, env, sources):
+    """records the .pro and the hashed inputs of every project, or drops the manifest if one is unknown"""
+    if not sources or not all(sources.itervalues()):
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        return
+
+    base = os.path.dirname(manifest)
+    projects = {}
+    for proj, pro in sources.iteritems():
+        inputs = _pro_inputs(pro)
+        projects[_relative(proj, base)] = {
+            'pro': _relative(pro, base),
+            'inputs': dict((_relative(path, base), _hash_file(path)) for path in inputs),
+            'volatile': _pro_volatile(pro, inputs),
+        }
+
+    with _AtomicFile(manifest) as f:
+        f.write(json.dumps({'env': env, 'projects': projects}, indent=1, sort_keys=True))
+
+def _load_manifest(manifest, env):
+    """{project: (pro, {input: hash}, volatile)} of the last run, or None if it was made with other inputs"""
+    try:
+        with open(manifest, 'rb') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if data.get('env') != env:
+        return None
+
+    base = os.path.dirname(manifest)
+    absolute = lambda path: os.path.normcase(os.path.normpath(os.path.join(base, path)))
+    return dict((absolute(proj), (absolute(entry['pro']), dict((absolute(path), digest) for path, digest in entry['inputs'].iteritems()), entry.get('volatile')))
+                for proj, entry in data['projects'].iteritems())
+
+def _regenerate(qmake_args, manifest, env, projects):
+    """reruns qmake without -r for the projects whose inputs changed, and for the solutions above them
+
+    Returns the failures, or None when only a full run can bring the tree up to date.
+    """
+    digests = {}
+    def changed(pro, inputs, volatile):
+        for path, digest in inputs.iteritems():
+            if path not in digests:
+                digests[path] = _hash_file(path)
+            if digests[path] != digest:
+                return True
+        return volatile is None or _pro_volatile(pro, inputs) != volatile
+
+    dirty = sorted(proj for proj, (pro, inputs, volatile) in projects.iteritems() if not os.path.exists(proj) or changed(pro, inputs, volatile))
+    if not dirty:
+        print 'All %d projects are up to date' % len(projects)
+        return []
+
+    if any(proj.endswith('.sln') for proj in dirty):
+        return None
+
+    dirs = set(os.path.dirname(projects[proj][0]) for proj in dirty)
+    solutions = sorted(proj for proj, (pro, inputs, volatile) in projects.iteritems()
+                       if proj.endswith('.sln') and any(d == os.path.dirname(pro) or d.startswith(os.path.join(os.path.dirname(pro), '')) for d in dirs))
+    print 'Regenerating %d of %d projects' % (len(dirty) + len(solutions), len(projects))
+
+    sources = dict((proj, pro) for proj, (pro, inputs, volatile) in projects.iteritems())
+    failures = []
+    pool = _cure_pool()
+    threads = multiprocessing.pool.ThreadPool(options.jobs)
+
+    def run(proj):
+        out = _PrefixedOutput('[%s] ' % os.path.basename(proj), sys.stdout)
+        err = _PrefixedOutput('[%s] ' % os.path.basename(proj), sys.stderr)
+        found = {}
+        proj_failures, code = _run_tree(_pro_args(qmake_args) + [sources[proj]], os.path.dirname(proj), pool, out, err, recursive = False, sources = found)
+        if code:
+            proj_failures.append((proj, 'qmake exited with %d' % code))
+        return proj, found, proj_failures
+
+    try:
+        # solutions last, as their cure reads the projects
+        for group in (dirty, solutions):
+            for proj, found, proj_failures in threads.map(run, group):
+                if found.keys() != [proj]:
+                    # the project was renamed or moved, which its solution has to learn about
+                    return None
+                failures += proj_failures
+    finally:
+        threads.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    if not failures:
+        _save_manifest(manifest, env, sources)
+    return failures
+
+def _run_incremental(qmake_args):
+    """regenerates only what changed since the last run's manifest, or the whole tree"""
+    manifest = os.path.join(os.getcwdu(), _manifest_name)
+    env = _manifest_env(qmake_args)
+
+    projects = None if options.full else _load_manifest(manifest, env)
+    if projects is not None:
+        failures = _regenerate(qmake_args, manifest, env, projects)
+        if failures is not None:
+            return failures
+
+    sources = {}
+    failures, code = _run_tree(qmake_args, sources = sources)
+    _save_manifest(manifest, env, sources if not (failures or code) else {})
+    return failures
+
+def _load_batch(manifest):
+    """[{"dir": ..., "args": [...], "spec": ...}, ...], dirs relative to the manifest"""
+    with open(manifest) as f:
+        trees = json.load(f)
+
+    base = os.path.dirname(manifest)
+    return [(os.path.normpath(os.path.join(base, tree['dir'])), tree.get('args', []), tree.get('spec') or os.environ.get('QMAKESPEC')) for tree in trees]
+
+def _run_batch(manifest, qmake_args):
+    trees = _load_batch(manifest)
+    summary = []
+
+    for spec in sorted(set(tree[2] for tree in trees), key=[tree[2] for tree in trees].index):
+        if not spec:
+            raise Exception('No QMAKESPEC for %s' % ', '.join(tree[0] for tree in trees if not tree[2]))
+
+        os.environ['QMAKESPEC'] = spec
+        start = time.time()
+        _prepare_env()
+        _profiler.span('prepare_env', start, time.time(), spec=spec)
+
+        group = [tree for tree in trees if tree[2] == spec]
+        if options.shared_props:
+            _share_props(tree[0] for tree in group)
+
+        # one worker pool per spec, shared by every tree using it
+        pool = _cure_pool()
+
+        def run(tree):
+            path, args, spec = tree
+            name = os.path.relpath(path)
+            out = _PrefixedOutput('[%s] ' % name, sys.stdout)
+            err = _PrefixedOutput('[%s] ' % name, sys.stderr)
+            start = time.time()
+            try:
+                failures, code = _run_tree(qmake_args + args, path, pool, out, err)
+            except Exception:
+                failures, code = [(path, traceback.format_exc())], None
+                print >> err, failures[0][1]
+
+            if code:
+                failures.append((path, 'qmake exited with %d' % code))
+            return (name, spec, time.time() - start, code, failures)
+
+        threads = multiprocessing.pool.ThreadPool(min(options.batch_jobs, len(group)))
+        try:
+            summary += threads.map(run, group)
+        finally:
+            threads.close()
+            if pool:
+                pool.close()
+                pool.join()
+            _clear_env()
+
+    print
+    print '%9s %6s %7s  %s' % ('seconds', 'qmake', 'failed', 'tree')
+    for name, spec, seconds, code, failures in summary:
+        print '%9.2f %6s %7d  %s (%s)' % (seconds, code, len(failures), name, spec)
+
+    return [failure for name, spec, seconds, code, failures in summary for failure in failures]
+
 def main():
     signal.signal(signal.SIGINT, _signal_handler)
 
-    subarg = 1
-    if len(sys.argv) > 1:
-        if sys.argv[1].startswith("--"):
-            toolset = next((k for k in globalInfo.msvc_vers if globalInfo.msvc_vers[k]['platformToolset'] == sys.argv[1][2:]), None)
-            if toolset:
-                platform = os.environ["QMAKESPEC"].split('-')[0] if "QMAKESPEC" in os.environ else 'win32'
-                os.environ["QMAKESPEC"] = "%s-%s" % (platform, toolset)
-                subarg = 2
+    qmake_args = _parse_args(sys.argv[1:])
+
+    start = time.time()
+    if options.batch:
+        failures = _run_batch(options.batch, qmake_args)
+    elif options.watch:
+        _prepare_env()
+        _profiler.span('prepare_env', start, time.time())
+        if options.shared_props:
+            _share_props((os.getcwd(),))
+        _watch(qmake_args)
+    else:
+        _prepare_env()
+        _profiler.span('prepare_env', start, time.time())
+        if options.shared_props:
+            _share_props((os.getcwd(),))
 
-    _prepare_env()
+        failures = _run_incremental(qmake_args) if options.incremental else _run_tree(qmake_args)[0]
 
-    print u'Running qmake @ ' + os.getcwdu()
-    process = subprocess.Popen(['qmake', '-d', '-tp', 'vc', '-r', '-spec', globalInfo.temp_mkspec] + sys.argv[subarg:],
-                               stderr=subprocess.PIPE)
+        _clear_env()
 
-    for proj in _getProjects(process.stderr):
-        _cure_projects(proj)
+    if options.cache:
+        _evict_cache()
 
-    _clear_env()
+    if options.profile:
+        _profiler.span('total', start, time.time())
+        _profiler.report(options.profile)
+
+    if failures:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,616 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import time
+import json
+import random
+import collections
+import shutil
+import platform
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import qmake2
+
+_configs = ('Release', 'Debug')
+
+def _condition(config):
+    return "'$(Configuration)|$(Platform)'=='%s|Win32'" % config
+
+def _other(config):
+    return _configs[1 - _configs.index(config)]
+
+def make_vcxproj(name, qt_path, mkspec, sources = 20, headers = 10, qrcs = 2, pch = True, includes = 20, libs = ('QtCore4', 'QtGui4')):
+    lines = []
+    a = lines.append
+
+    a(u'<?xml version="1.0" encoding="utf-8"?>')
+    a(u'<Project DefaultTargets="Build" ToolsVersion="4.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">')
+    a(u'  <ItemGroup Label="ProjectConfigurations">')
+    for c in _configs:
+        a(u'    <ProjectConfiguration Include="%s|Win32">' % c)
+        a(u'      <Configuration>%s</Configuration>' % c)
+        a(u'      <Platform>Win32</Platform>')
+        a(u'    </ProjectConfiguration>')
+    a(u'  </ItemGroup>')
+    a(u'  <PropertyGroup Label="Globals">')
+    a(u'    <ProjectGuid>{%08X-0000-0000-0000-000000000000}</ProjectGuid>' % (hash(name) & 0xffffffff))
+    a(u'    <RootNamespace>%s</RootNamespace>' % name)
+    a(u'    <Keyword>Qt4VSv1.0</Keyword>')
+    a(u'  </PropertyGroup>')
+    a(u'  <Import Project="$(VCTargetsPath)\\Microsoft.Cpp.Default.props" />')
+    for c in _configs:
+        a(u'  <PropertyGroup Condition="%s" Label="Configuration">' % _condition(c))
+        a(u'    <PlatformToolset>v90</PlatformToolset>')
+        a(u'    <OutputDirectory>%s\\</OutputDirectory>' % c.lower())
+        a(u'    <CharacterSet>NotSet</CharacterSet>')
+        a(u'    <ConfigurationType>Application</ConfigurationType>')
+        a(u'    <IntermediateDirectory>%s\\</IntermediateDirectory>' % c.lower())
+        a(u'    <PrimaryOutput>%s</PrimaryOutput>' % name)
+        a(u'  </PropertyGroup>')
+    a(u'  <Import Project="$(VCTargetsPath)\\Microsoft.Cpp.props" />')
+    a(u'  <ImportGroup Label="ExtensionSettings" />')
+    for c in _configs:
+        a(u'  <ImportGroup Condition="%s" Label="PropertySheets">' % _condition(c))
+        a(u'    <Import Project="$(UserRootDir)\\Microsoft.Cpp.$(Platform).user.props" Condition="exists(\'$(UserRootDir)\\Microsoft.Cpp.$(Platform).user.props\')" Label="LocalAppDataPlatform" />')
+        a(u'  </ImportGroup>')
+    a(u'  <PropertyGroup Label="UserMacros" />')
+    a(u'  <PropertyGroup>')
+    for c in _configs:
+        a(u'    <OutDir Condition="%s">%s\\</OutDir>' % (_condition(c), c.lower()))
+        a(u'    <IntDir Condition="%s">%s\\</IntDir>' % (_condition(c), c.lower()))
+        a(u'    <TargetName Condition="%s">%s</TargetName>' % (_condition(c), name))
+    a(u'  </PropertyGroup>')
+
+    include_dirs = ['"%s\\include\\Qt%s"' % (qt_path, lib[2:-1]) for lib in libs] + ['"%s\\include"' % qt_path]
+    include_dirs += ['..\\..\\src\\module%d' % k for k in xrange(includes)]
+    for c in _configs:
+        a(u'  <ItemDefinitionGroup Condition="%s">' % _condition(c))
+        a(u'    <ClCompile>')
+        a(u'      <AdditionalIncludeDirectories>%s</AdditionalIncludeDirectories>' % ';'.join(include_dirs + [mkspec, c.lower(), '.']))
+        a(u'      <AdditionalOptions>-Zm200 -w34100 -w34189 %(AdditionalOptions)</AdditionalOptions>')
+        a(u'      <PreprocessorDefinitions>UNICODE;WIN32;QT_LARGEFILE_SUPPORT;QT_DLL;QT_NO_DEBUG;QT_GUI_LIB;QT_CORE_LIB;%(PreprocessorDefinitions)</PreprocessorDefinitions>')
+        a(u'      <WarningLevel>Level3</WarningLevel>')
+        if pch:
+            a(u'      <PrecompiledHeader>Use</PrecompiledHeader>')
+            a(u'      <PrecompiledHeaderFile>stdafx.h</PrecompiledHeaderFile>')
+        a(u'      <DisableSpecificWarnings>4100;$(INHERIT)</DisableSpecificWarnings>')
+        a(u'    </ClCompile>')
+        a(u'    <Link>')
+        a(u'      <AdditionalDependencies>%s</AdditionalDependencies>' % ';'.join(['%s\\lib\\%s.lib' % (qt_path, lib) for lib in libs] + ['user32.lib', 'glu32.lib']))
+        a(u'      <AdditionalLibraryDirectories>%s\\lib;..\\lib;%%(AdditionalLibraryDirectories)</AdditionalLibraryDirectories>' % qt_path)
+        a(u'      <SubSystem>Windows</SubSystem>')
+        a(u'      <IgnoreSpecificDefaultLibraries>$(NOINHERIT)libcmt.lib</IgnoreSpecificDefaultLibraries>')
+        a(u'    </Link>')
+        a(u'    <ResourceCompile>')
+        a(u'      <PreprocessorDefinitions>UNICODE;QT_DLL;QT_GUI_LIB;%(PreprocessorDefinitions)</PreprocessorDefinitions>')
+        a(u'      <ResourceOutputFileName>%s\\$(InputName).res</ResourceOutputFileName>' % c.lower())
+        a(u'    </ResourceCompile>')
+        a(u'  </ItemDefinitionGroup>')
+
+    a(u'  <ItemGroup>')
+    for k in xrange(sources):
+        a(u'    <ClCompile Include="src\\file%d.cpp" />' % k)
+    for c in _configs:
+        for k in xrange(headers):
+            a(u'    <ClCompile Include="%s\\moc_file%d.cpp">' % (c.lower(), k))
+            a(u'      <ExcludedFromBuild Condition="%s">true</ExcludedFromBuild>' % _condition(_other(c)))
+            a(u'    </ClCompile>')
+        for k in xrange(qrcs):
+            a(u'    <ClCompile Include="%s\\qrc_res%d.cpp">' % (c.lower(), k))
+            a(u'      <ExcludedFromBuild Condition="%s">true</ExcludedFromBuild>' % _condition(_other(c)))
+            a(u'    </ClCompile>')
+    a(u'  </ItemGroup>')
+
+    a(u'  <ItemGroup>')
+    for k in xrange(headers):
+        a(u'    <CustomBuild Include="src\\file%d.h">' % k)
+        for c in _configs:
+            a(u'      <AdditionalInputs Condition="%s">%s\\bin\\moc.exe;src\\file%d.h;%%(AdditionalInputs)</AdditionalInputs>' % (_condition(c), qt_path, k))
+            a(u'      <Command Condition="%s">%s\\bin\\moc.exe -DUNICODE -DWIN32 src\\file%d.h -o %s\\moc_file%d.cpp</Command>' % (_condition(c), qt_path, k, c.lower(), k))
+            a(u'      <Message Condition="%s">MOC src\\file%d.h</Message>' % (_condition(c), k))
+            a(u'      <Outputs Condition="%s">%s\\moc_file%d.cpp;%%(Outputs)</Outputs>' % (_condition(c), c.lower(), k))
+        a(u'    </CustomBuild>')
+    for k in xrange(sources // 2):
+        a(u'    <ClInclude Include="src\\plain%d.h" />' % k)
+    if pch:
+        a(u'    <CustomBuild Include="stdafx.h">')
+        a(u'      <FileType>Document</FileType>')
+        for c in _configs:
+            a(u'      <Message Condition="%s">Generating precompiled header source file &apos;stdafx.h.cpp&apos; ...</Message>' % _condition(c))
+            a(u'      <Command Condition="%s">echo /*-------- &gt;stdafx.h.cpp</Command>' % _condition(c))
+            a(u'      <Outputs Condition="%s">stdafx.h.cpp;%%(Outputs)</Outputs>' % _condition(c))
+        a(u'    </CustomBuild>')
+    a(u'  </ItemGroup>')
+
+    a(u'  <ItemGroup>')
+    for c in _configs:
+        for k in xrange(min(headers, 2)):
+            a(u'    <CustomBuild Include="%s\\file%d.moc">' % (c.lower(), k))
+            a(u'      <ExcludedFromBuild Condition="%s">true</ExcludedFromBuild>' % _condition(_other(c)))
+            a(u'    </CustomBuild>')
+    for k in xrange(qrcs):
+        a(u'    <CustomBuild Include="res%d.qrc">' % k)
+        a(u'      <FileType>Document</FileType>')
+        for c in _configs:
+            a(u'      <AdditionalInputs Condition="%s">%s\\bin\\rcc.exe;images\\a%d.png;%%(AdditionalInputs)</AdditionalInputs>' % (_condition(c), qt_path, k))
+            a(u'      <Command Condition="%s">%s\\bin\\rcc.exe -name res%d res%d.qrc -o %s\\qrc_res%d.cpp</Command>' % (_condition(c), qt_path, k, k, c.lower(), k))
+            a(u'      <Message Condition="%s">RCC res%d.qrc</Message>' % (_condition(c), k))
+            a(u'      <Outputs Condition="%s">%s\\qrc_res%d.cpp;%%(Outputs)</Outputs>' % (_condition(c), c.lower(), k))
+        a(u'    </CustomBuild>')
+    a(u'  </ItemGroup>')
+
+    if pch:
+        a(u'  <ItemGroup>')
+        a(u'    <ClCompile Include="stdafx.h.cpp">')
+        for c in _configs:
+            a(u'      <ForcedIncludeFiles Condition="%s">stdafx.h</ForcedIncludeFiles>' % _condition(c))
+            a(u'      <PrecompiledHeaderFile Condition="%s">stdafx.h</PrecompiledHeaderFile>' % _condition(c))
+            a(u'      <PrecompiledHeader Condition="%s">Create</PrecompiledHeader>' % _condition(c))
+        a(u'    </ClCompile>')
+        a(u'  </ItemGroup>')
+
+    a(u'  <Import Project="$(VCTargetsPath)\\Microsoft.Cpp.targets" />')
+    a(u'  <ImportGroup Label="ExtensionTargets" />')
+    a(u'</Project>')
+
+    return lines
+
+def make_filters(sources = 20, headers = 10, qrcs = 2):
+    lines = []
+    a = lines.append
+
+    def item(mark, include, folder):
+        a(u'    <%s Include="%s">' % (mark, include))
+        a(u'      <Filter>%s</Filter>' % folder)
+        a(u'    </%s>' % mark)
+
+    a(u'<?xml version="1.0" encoding="utf-8"?>')
+    a(u'<Project ToolsVersion="4.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">')
+    a(u'  <ItemGroup>')
+    for folder, extensions in (('Source Files', 'cpp;c;cxx'), ('Header Files', 'h;hpp;hxx'), ('Generated Files', 'cpp;moc'), ('Resource Files', 'qrc;rc')):
+        a(u'    <Filter Include="%s">' % folder)
+        a(u'      <Extensions>%s</Extensions>' % extensions)
+        a(u'    </Filter>')
+    a(u'  </ItemGroup>')
+    a(u'  <ItemGroup>')
+    for k in xrange(sources):
+        item('ClCompile', 'src\\file%d.cpp' % k, 'Source Files')
+    for c in _configs:
+        for k in xrange(headers):
+            item('ClCompile', '%s\\moc_file%d.cpp' % (c.lower(), k), 'Generated Files')
+        for k in xrange(qrcs):
+            item('ClCompile', '%s\\qrc_res%d.cpp' % (c.lower(), k), 'Generated Files')
+    a(u'  </ItemGroup>')
+    a(u'  <ItemGroup>')
+    for k in xrange(headers):
+        item('CustomBuild', 'src\\file%d.h' % k, 'Header Files')
+    for k in xrange(sources // 2):
+        item('ClInclude', 'src\\plain%d.h' % k, 'Header Files')
+    for k in xrange(qrcs):
+        item('CustomBuild', 'res%d.qrc' % k, 'Resource Files')
+    a(u'  </ItemGroup>')
+    a(u'</Project>')
+
+    return lines
+
+def _guid(k):
+    return u'{%08X-1111-2222-3333-%012X}' % (k, k)
+
+def make_sln(projects = 100, dependencies = 4, seed = 1):
+    lines = []
+    a = lines.append
+    r = random.Random(seed)
+
+    a(u'Microsoft Visual Studio Solution File, Format Version 11.00')
+    a(u'# Visual Studio 2010')
+    for k in xrange(projects):
+        a(u'Project("{8BC9CEB8-8B4A-11D0-8D11-00A0C91BC942}") = "proj%d", "proj%d/proj%d.vcxproj", "%s"' % (k, k, k, _guid(k)))
+        a(u'EndProject')
+    a(u'Global')
+    a(u'\tGlobalSection(SolutionConfiguration) = preSolution')
+    a(u'\t\tConfigName.0 = Debug|Win32')
+    a(u'\t\tConfigName.1 = Release|Win32')
+    a(u'\tEndGlobalSection')
+    a(u'\tGlobalSection(ProjectDependencies) = postSolution')
+    for k in xrange(1, projects):
+        for n in xrange(min(dependencies, k)):
+            a(u'\t\t%s.%d = %s' % (_guid(k), n, _guid(r.randrange(k))))
+    a(u'\tEndGlobalSection')
+    a(u'\tGlobalSection(ProjectConfiguration) = postSolution')
+    for k in xrange(projects):
+        for c in reversed(_configs):
+            a(u'\t\t%s.%s|Win32.ActiveCfg = %s|Win32' % (_guid(k), c, c))
+            a(u'\t\t%s.%s|Win32.Build.0 = %s|Win32' % (_guid(k), c, c))
+    a(u'\tEndGlobalSection')
+    a(u'\tGlobalSection(ExtensibilityGlobals) = postSolution')
+    a(u'\tEndGlobalSection')
+    a(u'\tGlobalSection(ExtensibilityAddIns) = postSolution')
+    a(u'\tEndGlobalSection')
+    a(u'EndGlobal')
+
+    return lines
+
+def make_qmake_debug(projects = 100, noise = 200):
+    lines = []
+    a = lines.append
+
+    a('DEBUG 1: all.pro:1 TEMPLATE :: = subdirs')
+    for k in xrange(projects):
+        for n in xrange(noise):
+            a('DEBUG 1: proj%d/proj%d.pro:%d SOURCES :: += src/file%d.cpp' % (k, k, n, n))
+        a('DEBUG 1: QMAKE_MAKEFILE === proj%d/proj%d.vcxproj' % (k, k))
+    a('DEBUG 1: QMAKE_MAKEFILE === all.sln')
+
+    return lines
+
+def make_qmake_subdirs_debug(groups = 10, projects = 10, noise = 200):
+    """what qmake -r prints for a subdirs tree: each subdirs .pro is read before the projects below it are written"""
+    lines = []
+    a = lines.append
+
+    for n in xrange(noise):
+        a('DEBUG 1: all.pro:%d SUBDIRS :: += group%d' % (n, n % groups))
+    for g in xrange(groups):
+        for n in xrange(noise):
+            a('DEBUG 1: group%d/group%d.pro:%d SUBDIRS :: += proj%d' % (g, g, n, n % projects))
+        for k in xrange(projects):
+            for n in xrange(noise):
+                a('DEBUG 1: group%d/proj%d/proj%d.pro:%d SOURCES :: += src/file%d.cpp' % (g, k, k, n, n))
+                if n % 50 == 0:
+                    a('DEBUG 1: Project Parser: common.pri:%d CONFIG :: += qt' % n)
+            a('DEBUG 1: QMAKE_MAKEFILE === group%d/proj%d/proj%d.vcxproj' % (g, k, k))
+        a('DEBUG 1: QMAKE_MAKEFILE === group%d/group%d.sln' % (g, g))
+    a('DEBUG 1: QMAKE_MAKEFILE === all.sln')
+
+    return lines
+
+def _setup_global_info(qt_path = 'C:\\Qt\\4.8.7', mkspec = 'C:\\Temp\\qmake2_bench_mkspec'):
+    info = qmake2.globalInfo
+    info.major, info.minor, info.patch = '4', '8', '7'
+    info.path = qt_path
+    info.path_re = qmake2._make_path_re(qt_path)
+    info.temp_mkspec = mkspec
+    for k, v in info.msvc_vers['2008'].iteritems():
+        setattr(info, k, v)
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def _rates(result, lines, size, seconds):
+    result.update({
+        'lines': lines,
+        'bytes': size,
+        'lines_per_second': lines / seconds if seconds else None,
+        'mb_per_second': size / seconds / (1 << 20) if seconds else None,
+    })
+    return result
+
+def bench_ranges(lines = 50000):
+    _setup_global_info()
+    # every moc header costs ~16 lines, every source ~1.5
+    filelines = make_vcxproj('ranges', qmake2.globalInfo.path, qmake2.globalInfo.temp_mkspec, sources = lines // 18, headers = lines // 18)
+    path = os.path.join('bench', 'ranges.vcxproj')
+
+    start = time.time()
+    list(qmake2._cure_vcxproj(filelines, path, path))
+    elapsed = time.time() - start
+
+    return _rates({'seconds': elapsed}, len(filelines), len(qmake2._encodeLines(filelines)), elapsed)
+
+def _reversed_blocks(lines):
+    """lines with the children of every multi-line CustomBuild and ClCompile item in reverse order"""
+    result = []
+    block = None
+    for line in lines:
+        tag = line.strip()
+        if block is None and tag.startswith(('<CustomBuild ', '<ClCompile ')) and not tag.endswith('/>'):
+            result.append(line)
+            block = []
+        elif block is not None and tag in ('</CustomBuild>', '</ClCompile>'):
+            result += block[::-1] + [line]
+            block = None
+        elif block is not None:
+            block.append(line)
+        else:
+            result.append(line)
+    return result
+
+def _engine_corpus(scale):
+    qt_path, mkspec = qmake2.globalInfo.path, qmake2.globalInfo.temp_mkspec
+    return (
+        ('small', make_vcxproj('small', qt_path, mkspec)),
+        ('large', make_vcxproj('large', qt_path, mkspec, sources = 2000 * scale, headers = 1000 * scale, qrcs = 20, includes = 200)),
+        ('nopch', make_vcxproj('nopch', qt_path, mkspec, sources = 500 * scale, headers = 200 * scale, pch = False)),
+        ('noqt', make_vcxproj('noqt', qt_path, mkspec, sources = 500 * scale, headers = 200 * scale, libs = ())),
+        ('noqrc', make_vcxproj('noqrc', qt_path, mkspec, sources = 500 * scale, headers = 0, qrcs = 0)),
+        # blocks not in qmake's layout, which both engines have to leave alone alike
+        ('reordered', _reversed_blocks(make_vcxproj('reordered', qt_path, mkspec, sources = 200 * scale, headers = 100 * scale, qrcs = 5))),
+    )
+
+def bench_engines(scale = 1, repeat = 3):
+    """cures the corpus with both .vcxproj engines, checking they agree line for line"""
+    _setup_global_info()
+    engines = (('lines', qmake2._cure_vcxproj), ('xml', qmake2._cure_vcxproj_xml))
+    cases = {}
+
+    for name, filelines in _engine_corpus(scale):
+        path = os.path.join('bench', name + '.vcxproj')
+        outputs = {}
+        seconds = {}
+        for engine, doctor in engines:
+            for _ in xrange(repeat):
+                start = time.time()
+                outputs[engine] = list(doctor(filelines, path, path))
+                elapsed = time.time() - start
+                seconds[engine] = min(seconds.get(engine, elapsed), elapsed)
+
+        expected, actual = outputs['lines'], outputs['xml']
+        case = {'seconds': seconds, 'lines': len(filelines), 'equivalent': expected == actual}
+        if expected != actual:
+            case['first_difference'] = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+        cases[name] = case
+
+    return {
+        'scale': scale,
+        'equivalent': all(case['equivalent'] for case in cases.itervalues()),
+        'cases': cases,
+    }
+
+def _run_case(doctor, path, stream):
+    """times one doctor on one file; runs in its own interpreter so peak RSS belongs to the case"""
+    _setup_global_info()
+    size = os.path.getsize(path)
+    lines = qmake2._readBytes(path).count('\n') + 1
+    seconds = {}
+
+    result = {'seconds': seconds}
+
+    start = time.time()
+    if doctor == '_getProjects':
+        with open(path, 'rb') as f:
+            result['projects'] = len(list(qmake2._getProjects(f)))
+        seconds['cure'] = time.time() - start
+        # untimed: every makefile has to be put down to the .pro of the same name
+        sources = {}
+        with open(path, 'rb') as f:
+            list(qmake2._getProjects(f, sources))
+        result['misattributed'] = sum(1 for makefile, pro in sources.iteritems() if pro is None or
+                                      os.path.splitext(os.path.basename(pro))[0] != os.path.splitext(os.path.basename(makefile))[0])
+    elif stream:
+        qmake2.options.stream = True
+        qmake2._cure_path(path, getattr(qmake2, doctor))
+        seconds['cure'] = time.time() - start
+    else:
+        filelines = qmake2._decodeLines(qmake2._readBytes(path))
+        loaded = time.time()
+        content = list(getattr(qmake2, doctor)(filelines, path, path))
+        cured = time.time()
+        qmake2._writeBytes(path, qmake2._encodeLines(content))
+        seconds.update({'load': loaded - start, 'cure': cured - loaded, 'save': time.time() - cured})
+
+    seconds['total'] = time.time() - start
+    result['peak_rss_kb'] = _peak_rss_kb()
+
+    if not stream and doctor != '_getProjects':
+        # second, profiled pass over the same input for the per-handler breakdown
+        qmake2.options.profile = '-'
+        list(getattr(qmake2, doctor)(filelines, path, path))
+        result['handlers'] = qmake2._profiler._handler_summary()
+
+    return _rates(result, lines, size, seconds['total'])
+
+def _isolated(*args):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__.replace('.pyc', '.py')), 'case'] + list(args))
+    return json.loads(output)
+
+def _write(path, lines):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(qmake2._encodeLines(lines) + '\r\n')
+
+def _suite_inputs(scale):
+    qt_path, mkspec = 'C:\\Qt\\4.8.7', 'C:\\Temp\\qmake2_bench_mkspec'
+    return (
+        ('vcxproj_small', '_cure_vcxproj', '.vcxproj', make_vcxproj('small', qt_path, mkspec, sources = 50 * scale, headers = 20 * scale)),
+        ('vcxproj_large', '_cure_vcxproj', '.vcxproj', make_vcxproj('large', qt_path, mkspec, sources = 2000 * scale, headers = 1000 * scale, qrcs = 20, includes = 200)),
+        ('vcxproj_nopch', '_cure_vcxproj', '.vcxproj', make_vcxproj('nopch', qt_path, mkspec, sources = 500 * scale, headers = 200 * scale, pch = False)),
+        ('vcxproj_filters', '_cure_vcxproj_filters', '.vcxproj.filters', make_filters(sources = 2000 * scale, headers = 1000 * scale, qrcs = 20)),
+        ('sln', '_cure_sln', '.sln', make_sln(projects = 200 * scale, dependencies = 8)),
+        ('qmake_debug', '_getProjects', '.log', make_qmake_debug(projects = 400 * scale)),
+        ('qmake_subdirs', '_getProjects', '.log', make_qmake_subdirs_debug(groups = 20 * scale)),
+    )
+
+_qmake_stub = r"""#! %(python)s
+import os
+import sys
+import shutil
+
+with open(%(log)r, 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\n')
+
+if sys.argv[1:2] == ['-v']:
+    print 'QMake version 2.01a'
+    print 'Using Qt version 4.8.7 in %(qt)s'
+    sys.exit(0)
+
+recursive = '-r' in sys.argv
+pros = [arg for arg in sys.argv[1:] if arg.endswith('.pro')]
+
+def run(pro, target):
+    # a subdirs .pro is read before the projects below it are written, and its solution after them
+    directory, name = os.path.dirname(pro), os.path.splitext(os.path.basename(pro))[0]
+    for n in xrange(%(noise)d):
+        sys.stderr.write('DEBUG 1: %%s:%%d SOURCES :: += file%%d.cpp\n' %% (pro, n %% 20 + 1, n))
+    subdirs = sorted(d for d in os.listdir(directory) if os.path.isfile(os.path.join(directory, d, d + '.pro')))
+    for d in subdirs if recursive else ():
+        run(os.path.join(directory, d, d + '.pro'), os.path.join(target, d))
+
+    if target and not os.path.isdir(target):
+        os.makedirs(target)
+    for extension in ('.sln',) if subdirs else ('.vcxproj', '.vcxproj.filters'):
+        shutil.copyfile(os.path.join(directory, name + extension), os.path.join(target, name + extension))
+    sys.stderr.write('DEBUG 1: QMAKE_MAKEFILE === %%s\n' %% os.path.join(target, name + ('.sln' if subdirs else '.vcxproj')))
+
+run(os.path.abspath(pros[0]) if pros else os.path.join(%(source)r, 'all.pro'), '')
+"""
+
+def _bench_e2e(workdir, scale, args):
+    """runs the whole script against a fake qmake that replays a synthetic subdirs tree
+
+    Besides the cold and warm timings, checks the second warm run was served from the cure and environment caches
+    and that --incremental reruns qmake only for an edited project and the solution above it.
+    """
+    qt_path = os.path.join(workdir, 'qt')
+    source = os.path.join(workdir, 'source')
+    log = os.path.join(workdir, 'qmake.log')
+    projects = 20 * scale
+
+    _write(os.path.join(qt_path, 'mkspecs', 'win32-msvc2010', 'qmake.conf'), ['QMAKE_COMPILER_DEFINES += _MSC_VER=1600 WIN32'])
+    _write(os.path.join(qt_path, 'mkspecs', 'win32-msvc2005', 'qplatformdefs.h'), ['#include "../win32-msvc2008/qplatformdefs.h"'])
+    for k in xrange(projects):
+        _write(os.path.join(source, 'proj%d' % k, 'proj%d.pro' % k), ['TEMPLATE = app'] + ['SOURCES += file%d.cpp' % n for n in xrange(100)])
+        _write(os.path.join(source, 'proj%d' % k, 'proj%d.vcxproj' % k), make_vcxproj('proj%d' % k, qt_path, '/tmp/mkspec', sources = 100, headers = 40))
+        _write(os.path.join(source, 'proj%d' % k, 'proj%d.vcxproj.filters' % k), make_filters(sources = 100, headers = 40))
+    _write(os.path.join(source, 'all.pro'), ['TEMPLATE = subdirs', 'SUBDIRS = ' + ' '.join('proj%d' % k for k in xrange(projects))])
+    _write(os.path.join(source, 'all.sln'), make_sln(projects))
+
+    stub = os.path.join(workdir, 'bin', 'qmake')
+    os.makedirs(os.path.dirname(stub))
+    with open(stub, 'w') as f:
+        f.write(_qmake_stub % {'python': sys.executable, 'qt': os.path.join(qt_path, 'lib'), 'source': source, 'noise': 200, 'log': log})
+    os.chmod(stub, 0755)
+
+    env = dict(os.environ)
+    env['PATH'] = os.path.dirname(stub) + os.pathsep + env.get('PATH', '')
+    env['QMAKESPEC'] = 'win32-msvc2008'
+    env['QMAKE2_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    env['QMAKE2_ENV_DIR'] = os.path.join(workdir, 'env')
+    env.pop('QMAKE2_PROFILE', None)
+
+    # what qmake writes, all of which is cured
+    outputs = [os.path.join(root, name) for root, dirs, files in os.walk(source) for name in files if not name.endswith('.pro')]
+    size = sum(os.path.getsize(path) for path in outputs)
+    lines = sum(open(path, 'rb').read().count('\n') for path in outputs)
+
+    def run(tree, extra):
+        """seconds the run took and the qmake command lines it ran"""
+        if not os.path.isdir(tree):
+            os.makedirs(tree)
+        open(log, 'w').close()
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.abspath(qmake2.__file__.replace('.pyc', '.py'))] + extra + args, cwd=tree, env=env, stdout=devnull)
+        elapsed = time.time() - start
+        with open(log) as f:
+            return elapsed, f.read().splitlines()
+
+    def cache_hits(profile):
+        with open(profile) as f:
+            return collections.Counter(record.get('cache') for record in json.load(f)['files'])
+
+    cold = run(os.path.join(workdir, 'cold'), ['--no-cache', '--no-env-cache'])[0]
+    warm_tree = os.path.join(workdir, 'warm')
+    run(warm_tree, [])
+    # the second run in the same tree is served from the cure and environment caches; a run of nothing but
+    # cache hits calls no handler, so profiling it costs next to nothing
+    profile = os.path.join(workdir, 'warm.json')
+    warm, qmake_runs = run(warm_tree, ['--profile=' + profile])
+    hits = cache_hits(profile)
+    queried = any(line.startswith('-v') for line in qmake_runs)
+    if hits['hit'] != len(outputs) or queried:
+        raise Exception('warm run missed the caches: %d of %d cures hit, qmake -v %s' % (hits['hit'], len(outputs), 'ran' if queried else 'skipped'))
+
+    incremental_tree = os.path.join(workdir, 'incremental')
+    run(incremental_tree, ['--incremental'])
+    with open(os.path.join(source, 'proj0', 'proj0.pro'), 'ab') as f:
+        f.write('SOURCES += extra.cpp\r\n')
+    incremental, edited = run(incremental_tree, ['--incremental'])
+    unchanged = run(incremental_tree, ['--incremental'])[1]
+    # the edited project and the solution above it
+    regenerated = [line for line in edited if not line.startswith('-v')]
+    rerun = [line for line in unchanged if not line.startswith('-v')]
+    if len(regenerated) != 2 or rerun:
+        raise Exception('--incremental reran qmake %d times after one project changed and %d times after nothing did' % (len(regenerated), len(rerun)))
+
+    return (
+        _rates({'seconds': {'total': cold}, 'projects': projects}, lines, size, cold),
+        _rates({'seconds': {'total': warm}, 'projects': projects, 'cache_hits': hits['hit'], 'cache_misses': hits['miss']}, lines, size, warm),
+        _rates({'seconds': {'total': incremental}, 'projects': projects, 'qmake_runs': len(regenerated)}, lines, size, incremental),
+    )
+
+def bench_suite(scale = 1, stream = 0, e2e = 1):
+    workdir = tempfile.mkdtemp(prefix='qmake2_bench_')
+    cases = {}
+    try:
+        for name, doctor, extension, lines in _suite_inputs(scale):
+            path = os.path.join(workdir, 'inputs', name + extension)
+            _write(path, lines)
+            if doctor == '_cure_vcxproj_filters':
+                # filters are synced against their cured project
+                _setup_global_info()
+                project = qmake2._filters_project(path)
+                _write(project, make_vcxproj(name, qmake2.globalInfo.path, qmake2.globalInfo.temp_mkspec, sources = 2000 * scale, headers = 1000 * scale, qrcs = 20))
+                qmake2._cure_path(project, qmake2._cure_vcxproj)
+            cases[name] = _isolated(doctor, path, str(stream))
+
+        if e2e and os.name != 'nt':
+            cases['e2e_cold'], cases['e2e_warm'], cases['e2e_incremental'] = _bench_e2e(workdir, scale, ['--stream'] if stream else [])
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'python': platform.python_version(),
+        'scale': scale,
+        'stream': bool(stream),
+        'misattributed': sum(case.get('misattributed', 0) for case in cases.itervalues()),
+        'cases': cases,
+    }
+
+_benches = {
+    'suite': bench_suite,
+    'ranges': bench_ranges,
+    'engines': bench_engines,
+}
+
+def _value(v):
+    try:
+        return int(v)
+    except ValueError:
+        return v
+
+def main():
+    if sys.argv[1:2] == ['case']:
+        doctor, path, stream = sys.argv[2:5]
+        print json.dumps(_run_case(doctor, path, stream == '1'))
+        return
+
+    name = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('--') else 'suite'
+    kwargs = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    output = kwargs.pop('json', None)
+    result = _benches[name](**dict((k, _value(v)) for k, v in kwargs.iteritems()))
+
+    report = json.dumps(result, indent=2, sort_keys=True, separators=(',', ': '))
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+    if result.get('equivalent') is False or result.get('misattributed'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()